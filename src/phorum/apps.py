@@ -1,10 +1,16 @@
+import atexit
+
 from django.apps import AppConfig
-from django.db.models.fields import Field
+from django.contrib.auth.signals import user_logged_in
 
 
 class PhorumConfig(AppConfig):
     name = 'phorum'
 
     def ready(self):
-        from .models import UnaccentIRegex
-        Field.register_lookup(UnaccentIRegex)
+        from . import checks  # registers the system checks
+        from .presence import record_login
+        user_logged_in.connect(record_login, dispatch_uid="phorum_presence_login")
+        from .visits import room_visits
+        # uwsgi runs the exit functions when a worker is reloaded, e.g. by --reload-on-rss
+        atexit.register(room_visits.flush)
@@ -0,0 +1,27 @@
+from django.conf import settings
+from django.core.cache import DEFAULT_CACHE_ALIAS
+from django.core.checks import Error, register
+
+# settings naming cache aliases which have to be shared by all worker processes,
+# the default cache holds e.g. the room cache version
+SHARED_CACHE_SETTINGS = ("PRESENCE_CACHE", "ROOM_VISIT_CACHE", "SESSION_CACHE_ALIAS")
+
+PROCESS_LOCAL_CACHES = ("django.core.cache.backends.locmem.LocMemCache",)
+
+
+@register()
+def shared_caches_check(app_configs, **kwargs):
+    """Outside of DEBUG, the app runs in several processes which have to see the same cached data."""
+    if settings.DEBUG:
+        return []
+    errors = []
+    aliases = [(DEFAULT_CACHE_ALIAS, "CACHES")] + [(getattr(settings, setting), setting)
+                                                   for setting in SHARED_CACHE_SETTINGS]
+    for alias, setting in aliases:
+        if settings.CACHES[alias]['BACKEND'] in PROCESS_LOCAL_CACHES:
+            errors.append(Error(
+                "Cache '%s' of %s is local to the process." % (alias, setting),
+                hint="Use a cache shared by all worker processes, e.g. memcached.",
+                id="phorum.E001",
+            ))
+    return errors
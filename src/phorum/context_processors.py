@@ -1,26 +1,11 @@
-from datetime import timedelta
-
-from django.conf import settings
-from django.db.models import Q
-from django.utils.timezone import now
-from qsessions.models import Session
-
-from .models import PrivateMessage
+from .presence import presence
 
 
 def inbox_messages(request):
     inbox_unread_count = 0
     if request.user.is_authenticated:
-        # get all messages to/from this user
-        inbox_unread_count = PrivateMessage.objects \
-            .filter(Q(author=request.user) | Q(recipient=request.user))
-
-        # inbox visit time can be empty
-        if request.user.inbox_visit_time:
-            inbox_unread_count = inbox_unread_count \
-                .filter(created__gte=request.user.inbox_visit_time)
-        # get count
-        inbox_unread_count = inbox_unread_count.count()
+        # counter is kept up to date by PrivateMessage, see User.inbox_unread
+        inbox_unread_count = request.user.inbox_unread
 
     return {
         'inbox_unread_count': inbox_unread_count
@@ -28,13 +13,6 @@ def inbox_messages(request):
 
 
 def active_users(request):
-    active_threshold = now() - timedelta(minutes=settings.ACTIVE_USERS_TIMEOUT)
-
-    active_users_count = Session.objects\
-        .filter(user__isnull=False, expire_date__gte=now(), updated_at__gte=active_threshold)\
-        .distinct('user__username')\
-        .count()
-
     return {
-        'active_users_count': active_users_count
+        'active_users_count': presence.active_count()
     }
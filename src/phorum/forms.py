@@ -12,6 +12,7 @@ from django.utils.translation import gettext_lazy as _
 
 from .form_fields import AvatarImageField
 from .models import PrivateMessage, PublicMessage, Room, User, UserCustomization, UserRoomKeyring
+from .utils import keyring_cache
 
 
 class BaseMessageForm(forms.ModelForm):
@@ -237,10 +238,8 @@ class RoomPasswordPrompt(forms.Form):
             raise forms.ValidationError(u"Heslo je neplatné.")
 
         # save entry to keyring
-        keyring_record, created = UserRoomKeyring.objects.get_or_create(room=self.room, user=self.user)
-        if not created:
-            # save to update time
-            keyring_record.save()
+        UserRoomKeyring.objects.record_entry(self.user, self.room)
+        keyring_cache.invalidate(('user', self.user.pk))
 
         return password
 
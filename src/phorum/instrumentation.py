@@ -0,0 +1,126 @@
+import threading
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+
+from django.template.backends.django import DjangoTemplates, Template
+
+# metrics of the request being handled, see phorum.middleware.RequestInstrumentationMiddleware
+current_metrics = ContextVar("current_metrics", default=None)
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+class RequestMetrics(object):
+    """SQL queries, DB time and template render time of a single request.
+
+    The instance is installed by connection.execute_wrapper, queries executed
+    while rendering a template are counted in render_queries too.
+    """
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+        self.render_time = 0.0
+        self.render_queries = 0
+        self.rendering = False
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.db_time += time.perf_counter() - start
+            self.queries += 1
+
+    def server_timing(self, total_time):
+        """Value of the Server-Timing header, durations are in milliseconds."""
+        return 'db;dur=%.1f;desc="%d queries", tpl;dur=%.1f;desc="%d queries", total;dur=%.1f' % (
+            self.db_time * 1000, self.queries, self.render_time * 1000, self.render_queries, total_time * 1000)
+
+
+class TimedTemplate(Template):
+    def render(self, context=None, request=None):
+        metrics = current_metrics.get()
+        # templates rendered by other templates, e.g. forms, are timed within the outer one
+        if metrics is None or metrics.rendering:
+            return super(TimedTemplate, self).render(context, request)
+        metrics.rendering = True
+        queries = metrics.queries
+        start = time.perf_counter()
+        try:
+            return super(TimedTemplate, self).render(context, request)
+        finally:
+            metrics.render_time += time.perf_counter() - start
+            metrics.render_queries += metrics.queries - queries
+            metrics.rendering = False
+
+
+class InstrumentedDjangoTemplates(DjangoTemplates):
+    """Django template backend timing the rendering for RequestMetrics.
+
+    Django only sends the template_rendered signal in tests, so the templates
+    of the engine are wrapped instead.
+    """
+    def from_string(self, template_code):
+        return TimedTemplate(self.engine.from_string(template_code), self)
+
+    def get_template(self, template_name):
+        return TimedTemplate(super(InstrumentedDjangoTemplates, self).get_template(template_name).template, self)
+
+
+class Histogram(object):
+    """Counts of observed values in buckets given by their upper bounds, the last bucket is unbounded."""
+    def __init__(self, bounds):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+
+    def snapshot(self):
+        return {
+            'buckets': dict(zip(self.bounds + (float("inf"),), self.counts)),
+            'count': self.count,
+            'sum': self.total,
+        }
+
+
+class ViewStats(object):
+    """Process local histograms of request metrics per view name."""
+    metrics = {
+        'queries': (1, 2, 5, 10, 20, 50, 100, 200),
+        'db_time': (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000),  # ms
+        'render_time': (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000),  # ms
+        'response_size': (1024, 4096, 16384, 65536, 262144, 1048576),  # bytes
+    }
+
+    def __init__(self):
+        self._views = {}
+        self._lock = threading.Lock()
+
+    def observe(self, view_name, **values):
+        with self._lock:
+            histograms = self._views.get(view_name)
+            if histograms is None:
+                histograms = self._views[view_name] = {name: Histogram(bounds) for name, bounds in self.metrics.items()}
+            for name, value in values.items():
+                histograms[name].observe(value)
+
+    def snapshot(self):
+        """Get {view_name: {metric: histogram snapshot}}."""
+        with self._lock:
+            return {view_name: {name: histogram.snapshot() for name, histogram in histograms.items()}
+                    for view_name, histograms in self._views.items()}
+
+    def clear(self):
+        with self._lock:
+            self._views.clear()
+
+
+view_stats = ViewStats()
@@ -0,0 +1,90 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from ...models import PublicMessage, Room, User
+from ...utils import build_search_patterns, normalize_diacritics
+
+WORDS = (
+    "kočka", "pes", "škola", "žluťoučký", "kůň", "úpěl", "ďábelské", "ódy", "hudba", "koncert",
+    "kytara", "bicí", "zpěvák", "deska", "album", "fesťák", "parta", "večer", "město", "praha",
+    "brno", "vlak", "auto", "pivo", "čaj", "káva", "knížka", "film", "seriál", "hra",
+)
+
+LETTERS = "abcdeéěfghiíjklmnoprřsštuůvyýzž"
+
+DEFAULT_QUERIES = ("kocka", "zlutoucky kun", '"ďábelské ódy"', "kyt*", "*ťák")
+
+
+class Command(BaseCommand):
+    help = "Compare the trigram indexed search on folded text with the plain unaccent() scan " \
+           "on a generated corpus. " \
+           "The corpus is created inside a transaction which is rolled back afterwards."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--messages", type=int, default=100000, help="number of generated messages")
+        parser.add_argument("--repeat", type=int, default=5, help="runs of each query")
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("queries", nargs="*", default=DEFAULT_QUERIES)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        with transaction.atomic():
+            self.generate_corpus(rng, options['messages'])
+            for query in options['queries']:
+                patterns = build_search_patterns(query)
+                indexed, count = self.measure(options['repeat'], self.indexed_count, patterns)
+                legacy, legacy_count = self.measure(options['repeat'], self.legacy_count, patterns)
+                assert count == legacy_count, "both lookups have to return the same rows"
+                self.stdout.write("%-20s %7d matches  trigram %8.2f ms  unaccent scan %8.2f ms"
+                                  % (query, count, indexed * 1000, legacy * 1000))
+            transaction.set_rollback(True)
+
+    def generate_corpus(self, rng, count):
+        author = User.objects.create(username="benchmark-%d" % rng.randrange(10 ** 6))
+        room = Room.objects.create(name="benchmark-%d" % rng.randrange(10 ** 6))
+        batch = []
+        for i in range(count):
+            text = " ".join(self.random_word(rng) for _ in range(rng.randint(3, 40)))
+            batch.append(PublicMessage(room=room, author=author, text=text))
+            if len(batch) == 5000:
+                PublicMessage.objects.bulk_create(batch)
+                batch = []
+        PublicMessage.objects.bulk_create(batch)
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE phorum_publicmessage")
+        self.stdout.write("Generated %d messages." % count)
+
+    @staticmethod
+    def random_word(rng):
+        # searched words are sparse among random filler, as in real messages
+        if rng.random() < 0.02:
+            return rng.choice(WORDS)
+        return "".join(rng.choice(LETTERS) for _ in range(rng.randint(2, 9)))
+
+    @staticmethod
+    def measure(repeat, func, patterns):
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            result = func(patterns)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return best, result
+
+    @staticmethod
+    def indexed_count(patterns):
+        # the trigram index only covers messages which are not deleted, as searched
+        messages = PublicMessage.objects.filter(deleted_by=None)
+        for pattern in patterns:
+            messages = messages.filter(text_folded__iregex=normalize_diacritics(pattern))
+        return messages.count()
+
+    @staticmethod
+    def legacy_count(patterns):
+        where = " AND ".join(["deleted_by_id IS NULL"] + ["unaccent(text) ~* unaccent(%s)"] * len(patterns))
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT COUNT(*) FROM phorum_publicmessage WHERE " + where, patterns)
+            return cursor.fetchone()[0]
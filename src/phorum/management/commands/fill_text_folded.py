@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from ...models import PublicMessage
+from ...utils import normalize_diacritics
+
+
+class Command(BaseCommand):
+    help = "Fill the text_folded search column of public messages, in batches by id."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=2000)
+        parser.add_argument("--all", action="store_true",
+                            help="refill all messages, not only the ones with an empty column")
+
+    def handle(self, *args, **options):
+        messages = PublicMessage.objects.order_by("pk").only("text")
+        if not options['all']:
+            messages = messages.filter(text_folded="")
+        last_pk = 0
+        total = 0
+        while True:
+            batch = list(messages.filter(pk__gt=last_pk)[:options['batch_size']])
+            if not batch:
+                break
+            for message in batch:
+                message.text_folded = normalize_diacritics(message.text)
+            with transaction.atomic():
+                PublicMessage.objects.bulk_update(batch, ["text_folded"])
+            last_pk = batch[-1].pk
+            total += len(batch)
+        self.stdout.write("Folded text of %d messages filled." % total)
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from ...models import Room, RoomVisit, User
+
+
+class Command(BaseCommand):
+    help = "Recompute denormalized message counters from the message tables."
+
+    def handle(self, *args, **options):
+        for room in Room.objects.all():
+            room.update_message_counters()
+        self.stdout.write("Room message counters rebuilt.")
+        RoomVisit.objects.recount_new_messages()
+        self.stdout.write("Room visit counters rebuilt.")
+        User.objects.recount_inbox_unread()
+        self.stdout.write("Inbox unread counters rebuilt.")
@@ -1,7 +1,18 @@
+import logging
+import time
+
 import django.contrib.sessions.middleware
+from django.conf import settings
+from django.db import connection
 from django.utils.deprecation import MiddlewareMixin
 import qsessions.middleware
 
+from .instrumentation import current_metrics, view_stats, QueryBudgetExceeded, RequestMetrics
+from .presence import presence
+from .visits import room_visits
+
+logger = logging.getLogger(__name__)
+
 
 class UserSessionsMiddleware(
   qsessions.middleware.SessionMiddleware,
@@ -14,6 +25,62 @@ class UserActivityMiddleware(MiddlewareMixin):
     def process_request(self, request):
         assert hasattr(request, 'session')
         if request.user.is_authenticated:
-            if "last_action" in request.session:
-                del request.session['last_action']
-            request.session.modified = True
+            # refresh the session expiry at most once per SESSION_ACTIVITY_INTERVAL,
+            # active users are tracked by presence on every request
+            now = int(time.time())
+            if now - request.session.get('activity_time', 0) >= settings.SESSION_ACTIVITY_INTERVAL:
+                request.session['activity_time'] = now
+
+    def process_response(self, request, response):
+        user = getattr(request, 'user', None)
+        if user is not None and user.is_authenticated:
+            # views can set last_action, e.g. the room being read
+            presence.record(user.pk, getattr(request, 'last_action', None))
+        # visits collected by an otherwise idle process are written too
+        room_visits.flush_if_due()
+        return response
+
+
+class RequestInstrumentationMiddleware(object):
+    """Measure SQL queries, DB time, template render time and response size of requests.
+
+    The numbers are sent in the Server-Timing header and fed to the histograms
+    of phorum.instrumentation.view_stats. Views exceeding their QUERY_BUDGETS
+    are logged, or fail when QUERY_BUDGET_ACTION is "raise".
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        metrics = RequestMetrics()
+        token = current_metrics.set(metrics)
+        start = time.perf_counter()
+        try:
+            with connection.execute_wrapper(metrics):
+                response = self.get_response(request)
+        finally:
+            current_metrics.reset(token)
+        total_time = time.perf_counter() - start
+        response['Server-Timing'] = metrics.server_timing(total_time)
+
+        view_name = getattr(request, 'view_name', None)
+        if view_name is None:
+            return response
+        view_stats.observe(
+            view_name,
+            queries=metrics.queries,
+            db_time=metrics.db_time * 1000,
+            render_time=metrics.render_time * 1000,
+            response_size=0 if response.streaming else len(response.content),
+        )
+        budget = settings.QUERY_BUDGETS.get(view_name)
+        if budget is not None and metrics.queries > budget:
+            message = "View %s executed %d queries (%d while rendering), the budget is %d." % (
+                view_name, metrics.queries, metrics.render_queries, budget)
+            if settings.QUERY_BUDGET_ACTION == "raise":
+                raise QueryBudgetExceeded(message)
+            logger.warning(message)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request.view_name = view_func.__name__
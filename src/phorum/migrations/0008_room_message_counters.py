@@ -0,0 +1,31 @@
+from django.db import migrations, models
+from django.db.models import Count, Max
+
+
+def fill_room_counters(apps, schema_editor):
+    Room = apps.get_model("phorum", "Room")
+    for room in Room.objects.all():
+        counters = room.publicmessage_set.aggregate(total_messages=Count("id"),
+                                                    last_message_time=Max("created"))
+        Room.objects.filter(pk=room.pk).update(**counters)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('phorum', '0007_enable_unaccent'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='room',
+            name='total_messages',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='room',
+            name='last_message_time',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.RunPython(fill_room_counters, migrations.RunPython.noop),
+    ]
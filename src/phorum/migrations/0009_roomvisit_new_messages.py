@@ -0,0 +1,31 @@
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def fill_new_messages(apps, schema_editor):
+    PublicMessage = apps.get_model("phorum", "PublicMessage")
+    RoomVisit = apps.get_model("phorum", "RoomVisit")
+    new_messages = PublicMessage.objects\
+        .filter(room_id=OuterRef("room_id"), created__gt=OuterRef("visit_time"))\
+        .order_by()\
+        .values("room_id")\
+        .annotate(count=Count("id"))\
+        .values("count")
+    RoomVisit.objects.update(new_messages=Coalesce(Subquery(new_messages), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('phorum', '0008_room_message_counters'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='roomvisit',
+            name='new_messages',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(fill_new_messages, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,30 @@
+import django.contrib.postgres.indexes
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import migrations
+import django.db.models.expressions
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('phorum', '0009_roomvisit_new_messages'),
+    ]
+
+    operations = [
+        TrigramExtension(),
+        # unaccent() is only STABLE (it depends on the search path), index expressions need IMMUTABLE
+        migrations.RunSQL(
+            "CREATE OR REPLACE FUNCTION immutable_unaccent(text) RETURNS text AS "
+            "$$ SELECT public.unaccent('public.unaccent'::regdictionary, $1) $$ "
+            "LANGUAGE sql IMMUTABLE PARALLEL SAFE STRICT",
+            "DROP FUNCTION IF EXISTS immutable_unaccent(text)",
+        ),
+        migrations.AddIndex(
+            model_name='publicmessage',
+            index=django.contrib.postgres.indexes.GinIndex(
+                django.contrib.postgres.indexes.OpClass(
+                    django.db.models.expressions.Func('text', function='immutable_unaccent'),
+                    name='gin_trgm_ops'),
+                name='publicmessage_text_trgm'),
+        ),
+    ]
@@ -0,0 +1,27 @@
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('phorum', '0010_publicmessage_text_trgm'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='publicmessage',
+            name='search_vector',
+            field=models.GeneratedField(
+                db_persist=True,
+                expression=django.contrib.postgres.search.SearchVector(
+                    models.Func('text', function='immutable_unaccent'), config='simple'),
+                output_field=django.contrib.postgres.search.SearchVectorField()),
+        ),
+        migrations.AddIndex(
+            model_name='publicmessage',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'],
+                                                           name='publicmessage_search_vector'),
+        ),
+    ]
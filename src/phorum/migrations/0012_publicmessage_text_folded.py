@@ -0,0 +1,101 @@
+import unicodedata
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.db import migrations, models, transaction
+
+import phorum.models.fields
+
+
+class DiacriticsFolding(dict):
+    """Copy of phorum.utils.DiacriticsFolding as of this migration."""
+
+    # letters without a decomposition, folded to a single letter like unaccent() does (except ß, æ and œ)
+    letters = {
+        'Ł': 'L', 'ł': 'l', 'Ø': 'O', 'ø': 'o', 'Đ': 'D', 'đ': 'd', 'Ð': 'D', 'ð': 'd', 'Ħ': 'H', 'ħ': 'h',
+        'Ŧ': 'T', 'ŧ': 't', 'Ŀ': 'L', 'ŀ': 'l', 'ı': 'i', 'ß': 's', 'Æ': 'A', 'æ': 'a', 'Œ': 'O', 'œ': 'o',
+    }
+
+    def __missing__(self, char_code):
+        char = chr(char_code)
+        folded = self.letters.get(char) \
+            or ''.join(c for c in unicodedata.normalize('NFD', char) if unicodedata.category(c) != 'Mn')
+        self[char_code] = folded if len(folded) == 1 else char
+        return self[char_code]
+
+
+def fill_text_folded(apps, schema_editor):
+    # committed in batches, like the fill_text_folded management command
+    PublicMessage = apps.get_model("phorum", "PublicMessage")
+    folding = DiacriticsFolding()
+    messages = PublicMessage.objects.order_by("pk").only("text")
+    last_pk = 0
+    while True:
+        batch = list(messages.filter(pk__gt=last_pk)[:2000])
+        if not batch:
+            break
+        for message in batch:
+            message.text_folded = message.text.translate(folding)
+        with transaction.atomic():
+            PublicMessage.objects.bulk_update(batch, ["text_folded"])
+        last_pk = batch[-1].pk
+
+
+class Migration(migrations.Migration):
+    # the table is filled in committed batches, not in a single long transaction
+    atomic = False
+
+    dependencies = [
+        ('phorum', '0011_publicmessage_search_vector'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='publicmessage',
+            name='publicmessage_text_trgm',
+        ),
+        migrations.RemoveIndex(
+            model_name='publicmessage',
+            name='publicmessage_search_vector',
+        ),
+        migrations.RemoveField(
+            model_name='publicmessage',
+            name='search_vector',
+        ),
+        migrations.AlterField(
+            model_name='publicmessage',
+            name='text',
+            field=phorum.models.fields.MessageTextField(folded_field='text_folded'),
+        ),
+        migrations.AddField(
+            model_name='publicmessage',
+            name='text_folded',
+            field=models.TextField(default='', editable=False),
+        ),
+        migrations.RunPython(fill_text_folded, migrations.RunPython.noop),
+        migrations.AddField(
+            model_name='publicmessage',
+            name='search_vector',
+            field=models.GeneratedField(
+                db_persist=True,
+                expression=django.contrib.postgres.search.SearchVector('text_folded', config='simple'),
+                output_field=django.contrib.postgres.search.SearchVectorField()),
+        ),
+        migrations.AddIndex(
+            model_name='publicmessage',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['text_folded'], opclasses=['gin_trgm_ops'],
+                                                           name='publicmessage_text_folded_trgm'),
+        ),
+        migrations.AddIndex(
+            model_name='publicmessage',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'],
+                                                           name='publicmessage_search_vector'),
+        ),
+        # nothing uses the unaccent() wrapper anymore
+        migrations.RunSQL(
+            "DROP FUNCTION IF EXISTS immutable_unaccent(text)",
+            "CREATE OR REPLACE FUNCTION immutable_unaccent(text) RETURNS text AS "
+            "$$ SELECT public.unaccent('public.unaccent'::regdictionary, $1) $$ "
+            "LANGUAGE sql IMMUTABLE PARALLEL SAFE STRICT",
+        ),
+    ]
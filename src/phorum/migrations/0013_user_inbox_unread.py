@@ -0,0 +1,32 @@
+from django.db import migrations, models
+from django.db.models import Func, OuterRef, Q, Subquery
+
+
+def count_inbox_unread(apps, schema_editor):
+    # the same as User.objects.recount_inbox_unread(), which is also run by the rebuild_counters command
+    User = apps.get_model("phorum", "User")
+    PrivateMessage = apps.get_model("phorum", "PrivateMessage")
+
+    def unread_count(messages):
+        return Subquery(messages.order_by().annotate(count=Func("id", function="COUNT")).values("count"))
+
+    messages = PrivateMessage.objects.filter(Q(author_id=OuterRef("pk")) | Q(recipient_id=OuterRef("pk")))
+    User.objects.filter(inbox_visit_time=None).update(inbox_unread=unread_count(messages))
+    User.objects.exclude(inbox_visit_time=None).update(
+        inbox_unread=unread_count(messages.filter(created__gte=OuterRef("inbox_visit_time"))))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('phorum', '0012_publicmessage_text_folded'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='inbox_unread',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(count_inbox_unread, migrations.RunPython.noop),
+    ]
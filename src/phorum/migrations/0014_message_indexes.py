@@ -0,0 +1,51 @@
+import django.contrib.postgres.indexes
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('phorum', '0013_user_inbox_unread'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='publicmessage',
+            name='publicmessage_text_folded_trgm',
+        ),
+        migrations.RemoveIndex(
+            model_name='publicmessage',
+            name='publicmessage_search_vector',
+        ),
+        migrations.AddIndex(
+            model_name='publicmessage',
+            index=django.contrib.postgres.indexes.GinIndex(condition=models.Q(('deleted_by', None)),
+                                                           fields=['text_folded'], opclasses=['gin_trgm_ops'],
+                                                           name='publicmessage_text_folded_trgm'),
+        ),
+        migrations.AddIndex(
+            model_name='publicmessage',
+            index=django.contrib.postgres.indexes.GinIndex(condition=models.Q(('deleted_by', None)),
+                                                           fields=['search_vector'],
+                                                           name='publicmessage_search_vector'),
+        ),
+        migrations.AddIndex(
+            model_name='publicmessage',
+            index=models.Index(condition=models.Q(('thread', None)), fields=['room', '-last_reply', '-id'],
+                               name='publicmessage_room_threads'),
+        ),
+        migrations.AddIndex(
+            model_name='publicmessage',
+            index=models.Index(fields=['room', 'created'], name='publicmessage_room_created'),
+        ),
+        migrations.AddIndex(
+            model_name='privatemessage',
+            index=models.Index(condition=models.Q(('thread', None)), fields=['author', '-last_reply'],
+                               name='privatemsg_author_threads'),
+        ),
+        migrations.AddIndex(
+            model_name='privatemessage',
+            index=models.Index(condition=models.Q(('thread', None)), fields=['recipient', '-last_reply'],
+                               name='privatemsg_recipient_threads'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('phorum', '0014_message_indexes'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='privatemessage',
+            name='privatemsg_author_threads',
+        ),
+        migrations.RemoveIndex(
+            model_name='privatemessage',
+            name='privatemsg_recipient_threads',
+        ),
+        migrations.AddIndex(
+            model_name='privatemessage',
+            index=models.Index(condition=models.Q(('thread', None)), fields=['author', '-last_reply', '-id'],
+                               name='privatemsg_author_threads'),
+        ),
+        migrations.AddIndex(
+            model_name='privatemessage',
+            index=models.Index(condition=models.Q(('thread', None)), fields=['recipient', '-last_reply', '-id'],
+                               name='privatemsg_recipient_threads'),
+        ),
+    ]
@@ -0,0 +1,64 @@
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Q
+
+
+def fill_participants(apps, schema_editor):
+    PrivateMessage = apps.get_model("phorum", "PrivateMessage")
+    ConversationParticipant = apps.get_model("phorum", "ConversationParticipant")
+    participants = []
+    threads = PrivateMessage.objects.filter(thread=None)\
+        .select_related("author", "recipient")\
+        .annotate(replies=Count("children"))
+    for thread in threads.iterator(chunk_size=2000):
+        for user in {thread.author, thread.recipient}:
+            messages = PrivateMessage.objects.filter(Q(pk=thread.pk) | Q(thread_id=thread.pk)).exclude(author=user)
+            if user.inbox_visit_time:
+                messages = messages.filter(created__gte=user.inbox_visit_time)
+            participants.append(ConversationParticipant(
+                user=user, thread=thread, last_reply=thread.last_reply or thread.created,
+                unread=messages.exists(), message_count=thread.replies + 1))
+        if len(participants) >= 2000:
+            ConversationParticipant.objects.bulk_create(participants)
+            participants = []
+    ConversationParticipant.objects.bulk_create(participants)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('phorum', '0015_privatemessage_thread_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ConversationParticipant',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_reply', models.DateTimeField()),
+                ('unread', models.BooleanField(default=False)),
+                ('message_count', models.PositiveIntegerField(default=1)),
+                ('thread', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE,
+                                             related_name='participants', to='phorum.privatemessage')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE,
+                                           related_name='conversations', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user', '-last_reply', '-thread'],
+                                         name='conversation_user_threads')],
+                'constraints': [models.UniqueConstraint(fields=('user', 'thread'),
+                                                        name='conversationparticipant_unique')],
+            },
+        ),
+        migrations.RunPython(fill_participants, migrations.RunPython.noop),
+        # the inbox is read from the participants now
+        migrations.RemoveIndex(
+            model_name='privatemessage',
+            name='privatemsg_author_threads',
+        ),
+        migrations.RemoveIndex(
+            model_name='privatemessage',
+            name='privatemsg_recipient_threads',
+        ),
+    ]
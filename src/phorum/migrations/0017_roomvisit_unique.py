@@ -0,0 +1,28 @@
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('phorum', '0016_conversationparticipant'),
+    ]
+
+    operations = [
+        # keep the latest visit of each user and room
+        migrations.RunSQL(
+            "DELETE FROM phorum_roomvisit visit USING phorum_roomvisit newer "
+            "WHERE visit.room_id = newer.room_id AND visit.user_id = newer.user_id "
+            "AND (visit.visit_time, visit.id) < (newer.visit_time, newer.id)",
+            migrations.RunSQL.noop,
+        ),
+        migrations.AlterField(
+            model_name='roomvisit',
+            name='visit_time',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddConstraint(
+            model_name='roomvisit',
+            constraint=models.UniqueConstraint(fields=('room', 'user'), name='roomvisit_unique'),
+        ),
+    ]
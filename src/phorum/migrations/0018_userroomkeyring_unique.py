@@ -0,0 +1,22 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('phorum', '0017_roomvisit_unique'),
+    ]
+
+    operations = [
+        # keep the latest entry of each user and room
+        migrations.RunSQL(
+            "DELETE FROM phorum_userroomkeyring entry USING phorum_userroomkeyring newer "
+            "WHERE entry.room_id = newer.room_id AND entry.user_id = newer.user_id "
+            "AND (entry.last_successful_entry, entry.id) < (newer.last_successful_entry, newer.id)",
+            migrations.RunSQL.noop,
+        ),
+        migrations.AddConstraint(
+            model_name='userroomkeyring',
+            constraint=models.UniqueConstraint(fields=('room', 'user'), name='userroomkeyring_unique'),
+        ),
+    ]
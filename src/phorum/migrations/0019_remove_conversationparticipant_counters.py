@@ -0,0 +1,19 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('phorum', '0018_userroomkeyring_unique'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='conversationparticipant',
+            name='unread',
+        ),
+        migrations.RemoveField(
+            model_name='conversationparticipant',
+            name='message_count',
+        ),
+    ]
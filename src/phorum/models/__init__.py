@@ -1,39 +1,29 @@
 # coding=utf-8
 import os
-from collections import defaultdict
 
 from autoslug.fields import AutoSlugField
 from django.conf import settings
 from django.contrib.auth.hashers import make_password
 from django.contrib.auth.models import PermissionsMixin
 from django.contrib.auth.models import AbstractBaseUser
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVector, SearchVectorField
 from django.core.files.storage import FileSystemStorage
 from django.core.mail import send_mail
 from django.core.validators import MaxValueValidator, MinValueValidator
 from django.db import models, transaction
-from django.db.models import Lookup, Q
-from django.db.models.aggregates import Max
+from django.db.models import F, Func, OuterRef, Q, Subquery, Value
+from django.db.models.aggregates import Count, Max
+from django.db.models.functions import Greatest
 from django.utils import timezone
 from django.utils.deconstruct import deconstructible
 from django.utils.translation import gettext_lazy as _
 
 from .fields import MessageTextField, LastReplyField, RawContentFileField
-from .managers import UserManager, RoomVisitManager
-from .querysets import RoomQueryset
+from .managers import PublicMessageManager, UserManager, RoomVisitManager
+from .querysets import RoomQueryset, UserRoomKeyringQueryset
 from .utils import css_upload_path, js_upload_path
-
-
-class UnaccentIRegex(Lookup):
-    """Case-insensitive regex match with diacritics normalization.
-
-    Uses PostgreSQL's ~* operator with unaccent() on both sides.
-    """
-    lookup_name = 'unaccent_iregex'
-
-    def as_sql(self, compiler, connection):
-        lhs, lhs_params = self.process_lhs(compiler, connection)
-        rhs, rhs_params = self.process_rhs(compiler, connection)
-        return f"unaccent({lhs}) ~* unaccent(%s)", lhs_params + rhs_params
+from ..utils import SEARCH_CONFIG, bump_room_cache_version, bump_search_version, keyring_cache
 
 
 class User(AbstractBaseUser, PermissionsMixin):
@@ -88,6 +78,8 @@ class User(AbstractBaseUser, PermissionsMixin):
     avatar = models.ImageField(upload_to="avatars", blank=True)
     room_keyring = models.ManyToManyField("Room", through="UserRoomKeyring")
     inbox_visit_time = models.DateTimeField(null=True, blank=True)
+    # private messages since inbox_visit_time
+    inbox_unread = models.PositiveIntegerField(default=0, editable=False)
     last_ip = models.GenericIPAddressField(null=True, blank=True)
     max_thread_roots = models.SmallIntegerField(default=10, verbose_name="počet threadů na stránku",
                                                 validators=[MinValueValidator(1), MaxValueValidator(50)])
@@ -138,15 +130,16 @@ class User(AbstractBaseUser, PermissionsMixin):
 
     def update_inbox_visit_time(self):
         self.inbox_visit_time = timezone.now()
-        self.save()
+        self.inbox_unread = 0
+        self.save(update_fields=['inbox_visit_time', 'inbox_unread'])
 
     def increase_kredyti(self, count=1):
+        User.objects.filter(pk=self.pk).increase_kredyti(count)
         self.kredyti += count
-        self.save(update_fields=['kredyti'])
 
     def decrease_kredyti(self, count=1):
+        User.objects.filter(pk=self.pk).decrease_kredyti(count)
         self.kredyti -= min(count, self.kredyti)
-        self.save(update_fields=['kredyti'])
 
 
 class Room(models.Model):
@@ -163,6 +156,11 @@ class Room(models.Model):
     password_changed = models.DateTimeField(null=True, blank=True)
     visits = models.ManyToManyField(User, through="RoomVisit")
     pinned = models.BooleanField(default=False)
+    # denormalized counters, maintained by PublicMessage, see update_message_counters
+    total_messages = models.PositiveIntegerField(default=0, editable=False)
+    last_message_time = models.DateTimeField(null=True, blank=True, editable=False)
+
+    COUNTER_FIELDS = ("total_messages", "last_message_time")
 
     class Meta:
         ordering = ('-pinned', 'name')
@@ -170,6 +168,19 @@ class Room(models.Model):
     def __unicode__(self):
         return self.name
 
+    def save(self, *args, **kwargs):
+        if not self._state.adding and not args and kwargs.get("update_fields") is None:
+            # the counters are updated concurrently by PublicMessage, don't overwrite them with loaded values
+            kwargs["update_fields"] = [field.name for field in self._meta.concrete_fields
+                                       if not field.primary_key and field.name not in self.COUNTER_FIELDS]
+        super(Room, self).save(*args, **kwargs)
+        bump_room_cache_version()
+
+    def delete(self, *args, **kwargs):
+        result = super(Room, self).delete(*args, **kwargs)
+        bump_room_cache_version()
+        return result
+
     def can_be_modified_by(self, user):
         return user.is_superuser or user == self.author
 
@@ -180,25 +191,50 @@ class Room(models.Model):
         else:
             self.password = ""
             self.password_changed = None
+        # keyrings are checked against password_changed, drop them anyway not to keep stale entries
+        keyring_cache.invalidate(('room', self.pk))
 
     @property
     def protected(self):
         return bool(self.password)
 
+    def update_message_counters(self):
+        """Recompute denormalized message counters from messages in the room."""
+        counters = self.publicmessage_set.aggregate(total_messages=Count("id"),
+                                                    last_message_time=Max("created"))
+        Room.objects.filter(pk=self.pk).update(**counters)
+        self.total_messages = counters['total_messages']
+        self.last_message_time = counters['last_message_time']
+
 
 class RoomVisit(models.Model):
     objects = RoomVisitManager()
 
     room = models.ForeignKey(Room, on_delete=models.CASCADE)
     user = models.ForeignKey(User, on_delete=models.CASCADE)
-    visit_time = models.DateTimeField(auto_now=True)
+    # written in batches by RoomVisitBuffer, it's the time of the visit, not of the write
+    visit_time = models.DateTimeField(default=timezone.now)
+    # messages posted to the room since visit_time, maintained by PublicMessage
+    new_messages = models.PositiveIntegerField(default=0, editable=False)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["room", "user"], name="roomvisit_unique"),
+        ]
 
 
 class UserRoomKeyring(models.Model):
+    objects = UserRoomKeyringQueryset.as_manager()
+
     room = models.ForeignKey(Room, on_delete=models.CASCADE)
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     last_successful_entry = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["room", "user"], name="userroomkeyring_unique"),
+        ]
+
 
 class Message(models.Model):
     thread = models.ForeignKey("self", on_delete=models.CASCADE, null=True, blank=True, db_index=True,
@@ -216,25 +252,38 @@ class Message(models.Model):
 
     def save(self, *args, **kwargs):
         keep_last_reply = kwargs.pop('keep_last_reply', False)
-        super(Message, self).save(*args, **kwargs)
-        if self.thread and not keep_last_reply:
-            # update last_reply on parent
-            root = self.__class__.objects.get(pk=self.thread.pk)
-            root.last_reply = self.created
-            root.save()
+        adding = self._state.adding
+        with transaction.atomic():
+            super(Message, self).save(*args, **kwargs)
+            if adding:
+                self.after_create()
+            if self.thread_id and not keep_last_reply:
+                # update last_reply on parent, GREATEST keeps the newest one of concurrent replies
+                self.__class__.objects.filter(pk=self.thread_id)\
+                    .update(last_reply=Greatest("last_reply", Value(self.created)))
         return self
 
     def delete(self, using=None, keep_last_reply=False):
         """Actual delete of the message and the eventual thread below."""
         with transaction.atomic():
             super(Message, self).delete(using)
-            if self.thread:
+            if self.thread_id:
+                # newest of the remaining messages of the thread, computed by the UPDATE itself
                 max_date_in_thread = self.__class__.objects\
-                    .filter(Q(thread_id=self.thread_id) | Q(id=self.thread_id))\
-                    .aggregate(last_reply=Max("created"))['last_reply']
-                root = self.__class__.objects.get(pk=self.thread.pk)
-                root.last_reply = max_date_in_thread
-                root.save()
+                    .filter(Q(thread_id=OuterRef("pk")) | Q(pk=OuterRef("pk")))\
+                    .order_by()\
+                    .annotate(newest=Func("created", function="MAX"))\
+                    .values("newest")
+                self.__class__.objects.filter(pk=self.thread_id).update(last_reply=Subquery(max_date_in_thread))
+            self.after_delete()
+
+    def after_create(self):
+        """Hook called after a new message has been inserted."""
+        pass
+
+    def after_delete(self):
+        """Hook called (inside the delete transaction) after the message has been deleted."""
+        pass
 
     def delete_by(self, user):
         raise NotImplementedError()
@@ -250,10 +299,58 @@ class Message(models.Model):
             return True
         return None
 
+    @classmethod
+    def attach_delete_permissions(cls, threads, user):
+        """Set delete_allowed on threads and their child_messages in one pass.
+
+        delete_allowed tells whether the delete link is shown to the user,
+        the same as the delete_allowed template filter. Everything depending
+        only on the user is evaluated once, messages are checked using the
+        already fetched authors and rooms.
+        """
+        is_allowed = cls.delete_permission_check(user)
+        for thread in threads:
+            thread.delete_allowed = is_allowed(thread)
+            for child in getattr(thread, 'child_messages', ()):
+                child.delete_allowed = is_allowed(child)
+
+    @classmethod
+    def delete_permission_check(cls, user):
+        """Get function telling whether the delete link of a message is shown to the user."""
+        if not user.is_authenticated:
+            return lambda message: False
+        if user.is_admin:
+            return lambda message: True
+        return lambda message: message.author_id == user.id
+
 
 class PublicMessage(Message):
+    objects = PublicMessageManager()
+
     room = models.ForeignKey(Room, on_delete=models.CASCADE)
     deleted_by = models.ForeignKey(User, blank=True, null=True, on_delete=models.SET_NULL)
+    text = MessageTextField(folded_field="text_folded")
+    # text without diacritics, matched by search
+    text_folded = models.TextField(default="", editable=False)
+    # maintained by the database, used by the fulltext search engine
+    search_vector = models.GeneratedField(
+        expression=SearchVector("text_folded", config=SEARCH_CONFIG),
+        output_field=SearchVectorField(),
+        db_persist=True,
+    )
+
+    class Meta(Message.Meta):
+        indexes = [
+            # serve search, which never matches deleted messages
+            GinIndex(fields=["text_folded"], opclasses=["gin_trgm_ops"], name="publicmessage_text_folded_trgm",
+                     condition=Q(deleted_by=None)),
+            GinIndex(fields=["search_vector"], name="publicmessage_search_vector", condition=Q(deleted_by=None)),
+            # threads of a room page, newest reply first
+            models.Index(fields=["room", "-last_reply", "-id"], name="publicmessage_room_threads",
+                         condition=Q(thread=None)),
+            # new messages in a room since a visit, room counters
+            models.Index(fields=["room", "created"], name="publicmessage_room_created"),
+        ]
 
     @property
     def deleted(self):
@@ -261,22 +358,45 @@ class PublicMessage(Message):
 
     def delete(self, using=None):
         """Actual delete of the message and the eventual thread below."""
-        authors_post_counts = defaultdict(int)
-        if self.children:
-            for child in self.children.all():
-                authors_post_counts[child.author] += 1
         with transaction.atomic():
-            # delete message
+            # creation times of all deleted messages update the counters, see after_delete
+            self._deleted_created = [self.created]
+            if self.thread_id is None:
+                # authors of the replies deleted with the thread lose kredyti for each of them
+                replies = PublicMessage.objects.filter(thread_id=self.pk)
+                self._deleted_created += replies.values_list("created", flat=True)
+                reply_counts = replies.filter(author_id=OuterRef("pk"))\
+                    .order_by()\
+                    .annotate(count=Func("id", function="COUNT"))\
+                    .values("count")
+                User.objects.filter(pk__in=replies.values("author_id")).decrease_kredyti(Subquery(reply_counts))
             super(PublicMessage, self).delete(using)
-            # and decrease kredyti
-            for author, post_count in authors_post_counts.items():
-                author.decrease_kredyti(post_count)
+
+    def after_create(self):
+        # concurrent posts can commit in any order
+        Room.objects.filter(pk=self.room_id).update(
+            total_messages=F("total_messages") + 1,
+            last_message_time=Greatest("last_message_time", Value(self.created)))
+        RoomVisit.objects.filter(room_id=self.room_id).update(new_messages=F("new_messages") + 1)
+        bump_search_version(self.room_id)
+
+    def after_delete(self):
+        # newest of the remaining messages, read from the (room, created) index
+        newest = PublicMessage.objects.filter(room_id=OuterRef("pk"))\
+            .order_by()\
+            .annotate(newest=Func("created", function="MAX"))\
+            .values("newest")
+        Room.objects.filter(pk=self.room_id).update(
+            total_messages=F("total_messages") - len(self._deleted_created),
+            last_message_time=Subquery(newest))
+        RoomVisit.objects.filter(room_id=self.room_id).discount_deleted_messages(self._deleted_created)
+        bump_search_version(self.room_id)
 
     def delete_by(self, user):
         """Method to use when user deletes a message."""
         if self.can_be_deleted_by(user):
-            kredyti_penalty = 1 if user == self.author else 5
-            self.author.decrease_kredyti(kredyti_penalty)
+            kredyti_penalty = 1 if user.pk == self.author_id else 5
+            User.objects.filter(pk=self.author_id).decrease_kredyti(kredyti_penalty)
 
             now = timezone.now()
             in_delete_period = (now - self.created).total_seconds() < settings.ACTUAL_DELETE_PERIOD_SECONDS
@@ -292,11 +412,27 @@ class PublicMessage(Message):
             else:
                 self.deleted_by = user
                 self.save(keep_last_reply=True)
+            bump_search_version(self.room_id)
 
             return True
         else:
             return False
 
+    @classmethod
+    def delete_permission_check(cls, user):
+        if not user.is_authenticated or user.is_admin:
+            return super(PublicMessage, cls).delete_permission_check(user)
+        is_god = user.level == User.LEVEL_GOD
+
+        def is_allowed(message):
+            # same rules as can_be_deleted_by, deleted messages can be deleted only by admins
+            if message.deleted_by_id is not None:
+                return False
+            if message.author_id == user.id or user.id in (message.room.author_id, message.room.moderator_id):
+                return True
+            return is_god and message.author.level < User.LEVEL_1_DOT and message.room.god_can_delete_posts
+        return is_allowed
+
     def can_be_deleted_by(self, user):
         can_be_deleted = super(PublicMessage, self).can_be_deleted_by(user)
         if can_be_deleted is not None:
@@ -313,12 +449,45 @@ class PublicMessage(Message):
 class PrivateMessage(Message):
     private = True
 
+    def delete(self, using=None, keep_last_reply=False):
+        # replies are deleted with the thread, their authors and recipients need recount too
+        self._inbox_users = {self.author_id, self.recipient_id}
+        if self.thread_id is None:
+            for participants in self.children.values_list("author_id", "recipient_id"):
+                self._inbox_users.update(participants)
+        super(PrivateMessage, self).delete(using, keep_last_reply)
+
+    def after_create(self):
+        User.objects.filter(pk__in={self.author_id, self.recipient_id})\
+            .update(inbox_unread=F("inbox_unread") + 1)
+        if self.thread_id is None:
+            ConversationParticipant.objects.bulk_create(
+                ConversationParticipant(user_id=user_id, thread=self, last_reply=self.created)
+                for user_id in {self.author_id, self.recipient_id})
+        else:
+            ConversationParticipant.objects.filter(thread_id=self.thread_id).update(
+                last_reply=Greatest("last_reply", Value(self.created)))
+
+    def after_delete(self):
+        User.objects.filter(pk__in=self._inbox_users).recount_inbox_unread()
+        if self.thread_id is not None:
+            # participants of a deleted thread are deleted with it
+            root = PrivateMessage.objects.filter(pk=OuterRef("thread_id")).values("last_reply")
+            ConversationParticipant.objects.filter(thread_id=self.thread_id).update(
+                last_reply=Subquery(root))
+
     def delete_by(self, user):
         if self.can_be_deleted_by(user):
             self.delete()
             return True
         return False
 
+    @classmethod
+    def delete_permission_check(cls, user):
+        if not user.is_authenticated or user.is_admin:
+            return super(PrivateMessage, cls).delete_permission_check(user)
+        return lambda message: user.id in (message.author_id, message.recipient_id)
+
     def can_be_deleted_by(self, user):
         can_be_deleted = super(PrivateMessage, self).can_be_deleted_by(user)
         if can_be_deleted is not None:
@@ -328,6 +497,25 @@ class PrivateMessage(Message):
         return False
 
 
+class ConversationParticipant(models.Model):
+    """Private thread in the inbox of a user, author and recipient of the thread root have one each.
+
+    Maintained by PrivateMessage, so the inbox is read from this table only.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="conversations")
+    thread = models.ForeignKey(PrivateMessage, on_delete=models.CASCADE, related_name="participants")
+    last_reply = models.DateTimeField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["user", "thread"], name="conversationparticipant_unique"),
+        ]
+        indexes = [
+            # inbox of the user in keyset order, see InboxPage
+            models.Index(fields=["user", "-last_reply", "-thread"], name="conversation_user_threads"),
+        ]
+
+
 @deconstructible
 class OverwritingFileSystemStorage(FileSystemStorage):
     """
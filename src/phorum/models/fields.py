@@ -5,6 +5,7 @@ from django.utils.safestring import mark_safe
 from django_bleach.models import BleachField
 
 from .. import form_fields
+from ..utils import normalize_diacritics
 
 
 class LastReplyField(models.DateTimeField):
@@ -15,14 +16,32 @@ class LastReplyField(models.DateTimeField):
 
 
 class MessageTextField(BleachField):
-    """Bleach field extended with nl2br transformation before saving."""
+    """Bleach field extended with nl2br transformation before saving.
+
+    When folded_field is given, the cleaned text with diacritics removed is
+    stored to that field of the instance too.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.folded_field = kwargs.pop('folded_field', None)
+        super(MessageTextField, self).__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super(MessageTextField, self).deconstruct()
+        if self.folded_field:
+            kwargs['folded_field'] = self.folded_field
+        return name, path, args, kwargs
 
     def pre_save(self, model_instance, add):
         message = getattr(model_instance, self.attname).strip()
         message = linebreaksbr(mark_safe(message))
         if "<a" not in message:
             message = linkify(message)
-        return clean(message, **self.bleach_kwargs)
+        message = clean(message, **self.bleach_kwargs)
+        if self.folded_field:
+            # the folded field has to be declared after this one to be saved with the new value
+            setattr(model_instance, self.folded_field, normalize_diacritics(message))
+        return message
 
 
 class RawContentFileField(models.FileField):
@@ -1,22 +1,42 @@
+from functools import reduce
+from operator import or_
+
 from django.contrib.auth.models import BaseUserManager
-from django.db.models import Manager
+from django.db.models import Count, Manager, Q
 from django.utils import timezone
 
+from .querysets import RoomVisitQueryset, UserQueryset
+
+
+class RoomVisitManager(Manager.from_queryset(RoomVisitQueryset)):
+    def visits_for_user(self, user, pending=None):
+        """Get {room_id: new messages} of the rooms visited by the user.
+
+        pending are {room_id: visit_time} of visits not written yet, see
+        RoomVisitBuffer, the new messages are counted for the ones newer than
+        the stored visits.
+        """
+        from . import PublicMessage
+
+        visits = {room_id: (visit_time, new_messages) for room_id, visit_time, new_messages
+                  in self.filter(user=user).values_list("room", "visit_time", "new_messages")}
+        newer = {room_id: visit_time for room_id, visit_time in (pending or {}).items()
+                 if visit_time is not None and (room_id not in visits or visits[room_id][0] < visit_time)}
+        counts = dict.fromkeys(newer, 0)
+        if newer:
+            messages = PublicMessage.objects.filter(
+                reduce(or_, (Q(room_id=room_id, created__gt=visit_time) for room_id, visit_time in newer.items())))
+            counts.update(messages.order_by().values_list("room_id").annotate(count=Count("id")))
+        return {room_id: new_messages for room_id, (_, new_messages) in visits.items()} | counts
+
 
-class RoomVisitManager(Manager):
-    def visits_for_user(self, user):
-        visits = self.filter(user=user).extra(
-            select={
-                'new_messages': 'SELECT COUNT(*) FROM "phorum_publicmessage" '
-                                'WHERE "phorum_publicmessage"."created" > "phorum_roomvisit"."visit_time" '
-                                'AND "phorum_publicmessage"."room_id" = "phorum_roomvisit"."room_id"'
-            }
-        ) \
-            .values_list("room", "new_messages")
-        return dict(visits)
+class PublicMessageManager(Manager):
+    def get_queryset(self):
+        # search vector is only used for filtering, don't load it with the messages
+        return super(PublicMessageManager, self).get_queryset().defer("search_vector")
 
 
-class UserManager(BaseUserManager):
+class UserManager(BaseUserManager.from_queryset(UserQueryset)):
     use_in_migrations = True
 
     def _create_user(self, username, email, password,
@@ -1,4 +1,7 @@
-from django.db import models
+from django.db import connections, models
+from django.db.models import Count, F, Func, OuterRef, Q, Subquery, Value
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import Coalesce, Greatest
 
 
 class RoomQueryset(models.QuerySet):
@@ -7,3 +10,90 @@ class RoomQueryset(models.QuerySet):
 
     def not_pinned(self):
         return self.filter(pinned=False)
+
+
+class RoomVisitQueryset(models.QuerySet):
+    def recount_new_messages(self):
+        """Recompute new message counters of the visits from their visit times."""
+        from . import PublicMessage
+
+        new_messages = PublicMessage.objects\
+            .filter(room_id=OuterRef("room_id"), created__gt=OuterRef("visit_time"))\
+            .order_by()\
+            .values("room_id")\
+            .annotate(count=Count("id"))\
+            .values("count")
+        return self.update(new_messages=Coalesce(Subquery(new_messages), 0))
+
+    def discount_deleted_messages(self, created):
+        """Decrease new message counters of the visits by deleted messages created at the given times.
+
+        Only visits older than some of the messages are updated, each by
+        the number of messages newer than the visit.
+        """
+        newer = RawSQL('(SELECT COUNT(*) FROM unnest(%%s::timestamptz[]) AS deleted(created) '
+                       'WHERE deleted.created > "%s"."visit_time")' % self.model._meta.db_table,
+                       (list(created),), output_field=models.IntegerField())
+        return self.filter(visit_time__lt=max(created))\
+            .update(new_messages=Greatest(F("new_messages") - newer, Value(0)))
+
+    def upsert_visits(self, visits):
+        """Store (user_id, room_id, visit_time) visits with a single INSERT ... ON CONFLICT DO UPDATE.
+
+        Visit times never go back, new message counters are counted from the
+        messages for the written visit times. Rows are locked in the order of
+        (room_id, user_id), so concurrent writes of overlapping batches don't
+        deadlock.
+        """
+        from . import PublicMessage, Room, User
+
+        if not visits:
+            return
+        table = self.model._meta.db_table
+        messages_table = PublicMessage._meta.db_table
+        visits = sorted(visits, key=lambda visit: (visit[1], visit[0]))
+        values = ", ".join(["(%s::integer, %s::integer, %s::timestamptz)"] * len(visits))
+        with connections[self.db].cursor() as cursor:
+            cursor.execute(
+                f"INSERT INTO {table} AS visit (user_id, room_id, visit_time, new_messages) "
+                f"SELECT v.user_id, v.room_id, v.visit_time, "
+                f"(SELECT COUNT(*) FROM {messages_table} m WHERE m.room_id = v.room_id AND m.created > v.visit_time) "
+                f"FROM (VALUES {values}) AS v (user_id, room_id, visit_time) "
+                # users or rooms can be deleted before the visits are written
+                f"JOIN {User._meta.db_table} u ON u.id = v.user_id JOIN {Room._meta.db_table} r ON r.id = v.room_id "
+                # the joins don't keep the order of the values
+                f"ORDER BY v.room_id, v.user_id "
+                f"ON CONFLICT (room_id, user_id) DO UPDATE SET "
+                f"visit_time = EXCLUDED.visit_time, new_messages = EXCLUDED.new_messages "
+                f"WHERE visit.visit_time < EXCLUDED.visit_time",
+                [value for visit in visits for value in visit])
+
+
+class UserRoomKeyringQueryset(models.QuerySet):
+    def record_entry(self, user, room):
+        """Store successful entry of the room password with a single INSERT ... ON CONFLICT DO UPDATE."""
+        self.bulk_create([self.model(user=user, room=room)], update_conflicts=True,
+                         unique_fields=["room", "user"], update_fields=["last_successful_entry"])
+
+
+class UserQueryset(models.QuerySet):
+    def increase_kredyti(self, count=1):
+        return self.update(kredyti=F("kredyti") + count)
+
+    def decrease_kredyti(self, count=1):
+        """Decrease kredyti of the users, count can be an expression evaluated per user."""
+        return self.update(kredyti=Greatest(F("kredyti") - count, Value(0)))
+
+    def recount_inbox_unread(self):
+        """Recompute unread inbox counters of the users from their inbox visit times."""
+        from . import PrivateMessage
+
+        def unread_count(messages):
+            # plain COUNT() without GROUP BY, the subquery counts all messages of the user
+            return Subquery(messages.order_by().annotate(count=Func("id", function="COUNT")).values("count"))
+
+        messages = PrivateMessage.objects.filter(Q(author_id=OuterRef("pk")) | Q(recipient_id=OuterRef("pk")))
+        # inbox visit time can be empty, all messages are unread then
+        self.filter(inbox_visit_time=None).update(inbox_unread=unread_count(messages))
+        self.exclude(inbox_visit_time=None).update(
+            inbox_unread=unread_count(messages.filter(created__gte=OuterRef("inbox_visit_time"))))
@@ -0,0 +1,97 @@
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+
+
+class PresenceTracker(object):
+    """Sliding window of recently active users kept in a cache.
+
+    Users seen in a request are recorded together with their last action
+    in buckets of `bucket_size` seconds. Active users are the ones recorded
+    in the buckets of the last `ACTIVE_USERS_TIMEOUT` minutes, older buckets
+    simply expire from the cache. The cache has to be shared by all worker
+    processes to get the same numbers in each of them.
+
+    A bucket is a counter of its slots, a key per slot holding the user ID
+    and a key per user holding the last action. Processes only add keys and
+    increment the counter, so they don't overwrite users recorded by others.
+    """
+    key_prefix = "presence"
+
+    def __init__(self, cache_alias=None, bucket_size=60):
+        self.cache_alias = cache_alias
+        self.bucket_size = bucket_size
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias or settings.PRESENCE_CACHE]
+
+    @property
+    def window(self):
+        return settings.ACTIVE_USERS_TIMEOUT * 60
+
+    @property
+    def timeout(self):
+        return self.window + self.bucket_size
+
+    def buckets(self, now=None):
+        """Buckets in the window, from the oldest one."""
+        current = int((now or time.time()) // self.bucket_size)
+        count = self.window // self.bucket_size + 1
+        return range(current - count + 1, current + 1)
+
+    def count_key(self, bucket):
+        return "%s:%d:count" % (self.key_prefix, bucket)
+
+    def slot_key(self, bucket, slot):
+        return "%s:%d:slot:%d" % (self.key_prefix, bucket, slot)
+
+    def user_key(self, bucket, user_id):
+        return "%s:%d:user:%d" % (self.key_prefix, bucket, user_id)
+
+    def record(self, user_id, last_action=None):
+        """Mark the user as active, the cache is written only when something changes."""
+        bucket = self.buckets()[-1]
+        key = self.user_key(bucket, user_id)
+        missing = object()
+        recorded = self.cache.get(key, missing)
+        if recorded is missing and self.cache.add(key, last_action, self.timeout):
+            # the user is new in the bucket
+            count_key = self.count_key(bucket)
+            self.cache.add(count_key, 0, self.timeout)
+            try:
+                slot = self.cache.incr(count_key)
+            except ValueError:
+                # the counter is gone, e.g. the cache failed, the user is counted in the next bucket
+                return
+            self.cache.set(self.slot_key(bucket, slot), user_id, self.timeout)
+        elif recorded != last_action:
+            self.cache.set(key, last_action, self.timeout)
+
+    def remove(self, user_id):
+        """Forget the user, e.g. on logout."""
+        self.cache.delete_many([self.user_key(bucket, user_id) for bucket in self.buckets()])
+
+    def active_users(self):
+        """Get {user_id: last action} of the users active in the window."""
+        buckets = self.buckets()
+        counts = self.cache.get_many([self.count_key(bucket) for bucket in buckets])
+        slot_keys = [(bucket, self.slot_key(bucket, slot)) for bucket in buckets
+                     for slot in range(1, counts.get(self.count_key(bucket), 0) + 1)]
+        slots = self.cache.get_many([key for _, key in slot_keys])
+        # from the oldest bucket, newer last actions override the older ones
+        user_keys = {self.user_key(bucket, slots[key]): slots[key] for bucket, key in slot_keys if key in slots}
+        last_actions = self.cache.get_many(list(user_keys))
+        return {user_id: last_actions[key] for key, user_id in user_keys.items() if key in last_actions}
+
+    def active_count(self):
+        return len(self.active_users())
+
+
+presence = PresenceTracker()
+
+
+def record_login(sender, request, user, **kwargs):
+    # the user counts as active since the login, not from the response of the next request
+    presence.record(user.pk)
@@ -1,28 +1,21 @@
 import re
-import unicodedata
+from functools import lru_cache
 
 from django import template
 from django.utils.safestring import mark_safe
 
-from ..utils import parse_search_query
+from ..utils import normalize_diacritics, parse_search_query
 
 register = template.Library()
 
 
-def normalize_diacritics(text):
-    """Remove diacritics from text for comparison."""
-    return ''.join(
-        c for c in unicodedata.normalize('NFD', text)
-        if unicodedata.category(c) != 'Mn'
-    )
-
-
 def build_highlight_pattern(token, is_phrase=False):
     r"""Build regex pattern for highlighting a single token.
 
     Uses \b (Python word boundary) instead of \y (PostgreSQL).
     For phrases, wildcards are literal.
     Token is normalized (diacritics removed) to match normalized text.
+    Wildcards don't match '<', so a match never reaches into an HTML tag.
     """
     # Normalize token for diacritics-insensitive matching
     normalized_token = normalize_diacritics(token)
@@ -38,69 +31,71 @@ def build_highlight_pattern(token, is_phrase=False):
     # Remove edge wildcards for processing
     inner = normalized_token.lstrip('*').rstrip('*')
 
-    # Escape and replace internal wildcards (\S* = non-whitespace, greedy)
-    escaped = re.escape(inner).replace(r'\*', r'\S*')
+    # Escape and replace internal wildcards (non-whitespace outside of tags, greedy)
+    escaped = re.escape(inner).replace(r'\*', r'[^\s<]*')
 
-    # Add prefix/suffix: \S* for wildcard (greedy to match whole word), \b for word boundary
-    prefix = r'\S*' if has_start_wildcard else r'\b'
-    suffix = r'\S*' if has_end_wildcard else r'\b'
+    # Add prefix/suffix: wildcard (greedy to match whole word), \b for word boundary
+    prefix = r'[^\s<]*' if has_start_wildcard else r'\b'
+    suffix = r'[^\s<]*' if has_end_wildcard else r'\b'
 
     return prefix + escaped + suffix
 
 
-@register.filter
-def highlight_search(text, query):
+@lru_cache(maxsize=256)
+def compile_highlight_pattern(query):
+    """Compile pattern matching either an HTML tag (group 'tag') or any token of the query.
+
+    Returns None for queries without tokens.
     """
+    tokens = parse_search_query(query)
+    if not tokens:
+        return None
+    token_patterns = [build_highlight_pattern(t.text, t.is_phrase) for t in tokens]
+    return re.compile(r'(?P<tag><[^>]+>)|' + '|'.join(f'(?:{p})' for p in token_patterns), re.IGNORECASE)
+
+
+def highlight(text, query, folded_text=None):
+    r"""
     Highlight search matches in HTML text.
 
     Handles:
     - HTML content (doesn't highlight inside tags)
-    - Wildcard patterns (* → \S*) for words only (non-whitespace)
+    - Wildcard patterns (* → [^\s<]*) for words only (non-whitespace)
     - Case-insensitive matching
     - Diacritics-insensitive matching
     - Multiple tokens (quoted phrases and words)
+
+    Matches are searched in the diacritics-normalized text in a single pass,
+    tags are matched too so that they are skipped over, and the output is
+    joined from slices of the original text.
     """
     if not query or not text:
         return text
 
-    # Parse query into tokens and build combined pattern
-    tokens = parse_search_query(query)
-    token_patterns = [build_highlight_pattern(t.text, t.is_phrase) for t in tokens]
-    pattern = '|'.join(f'({p})' for p in token_patterns)
-
-    def highlight_text_segment(segment):
-        """Highlight matches in a text segment (not HTML tags)."""
-        # Normalize segment for diacritics-insensitive matching
-        normalized = normalize_diacritics(segment)
-
-        # Find all matches in normalized text
-        matches = list(re.finditer(pattern, normalized, re.IGNORECASE))
-        if not matches:
-            return segment
+    pattern = compile_highlight_pattern(query)
+    if pattern is None:
+        return text
 
-        # Apply highlights in reverse order to preserve positions
-        result = segment
-        for match in reversed(matches):
-            start, end = match.start(), match.end()
-            original_match = segment[start:end]
-            result = result[:start] + '<mark class="search-highlight">' + original_match + '</mark>' + result[end:]
+    if not folded_text or len(folded_text) != len(text):
+        folded_text = normalize_diacritics(text)
 
-        return result
+    parts = []
+    last_end = 0
+    for match in pattern.finditer(folded_text):
+        start, end = match.span()
+        if match.lastgroup == 'tag' or start == end:
+            continue
+        parts += [text[last_end:start], '<mark class="search-highlight">', text[start:end], '</mark>']
+        last_end = end
+    parts.append(text[last_end:])
 
-    # Split text into HTML tags and text segments
-    # Pattern matches HTML tags
-    parts = re.split(r'(<[^>]+>)', text)
+    return mark_safe(''.join(parts))
 
-    result_parts = []
-    for part in parts:
-        if part.startswith('<') and part.endswith('>'):
-            # This is an HTML tag, don't modify
-            result_parts.append(part)
-        else:
-            # This is text content, highlight matches
-            result_parts.append(highlight_text_segment(part))
 
-    return mark_safe(''.join(result_parts))
+@register.filter
+def highlight_message(message, query):
+    """Highlight search matches in message text, using its stored text_folded."""
+    return highlight(message.text, query, getattr(message, 'text_folded', None))
 
 
 @register.filter
@@ -117,6 +112,51 @@ def is_newer_than(message, compared_time=None):
     return message.created > compared_time
 
 
+@register.simple_tag(takes_context=True)
+def message_version(context, message):
+    """Get version of the rendered message for the fragment cache in parts/message.html.
+
+    Covers everything the rendering depends on besides the message id - the
+    deletion, author's profile and flags specific to the viewing user.
+    """
+    user = context['request'].user
+    last_visit_time = context.get('last_visit_time')
+    author = message.author
+    private = getattr(message, 'private', False)
+    flags = []
+    if user.is_authenticated:
+        flags.append('auth')
+        if message.author_id == user.id:
+            flags.append('sent')
+        elif message.recipient_id == user.id:
+            flags.append('received')
+        if delete_allowed(message, user):
+            flags.append('delete')
+        if last_visit_time:
+            flags.append('visited')
+        if is_newer_than(message, last_visit_time):
+            flags.append('new')
+        last_child = getattr(message, 'last_child', None)
+        if last_child and is_newer_than(last_child, last_visit_time):
+            flags.append('new-child')
+    deleted_by_id = getattr(message, 'deleted_by_id', None)
+    return ':'.join(str(part) for part in (
+        deleted_by_id, message.deleted_by.username if deleted_by_id else '',
+        author.username, author.avatar.name, author.level,
+        message.recipient.username if message.recipient_id else '',
+        '' if private else message.room.slug,
+        '.'.join(flags),
+    ))
+
+
 @register.filter
-def can_be_deleted_by(message, user):
-    return message.can_be_deleted_by(user)
+def delete_allowed(message, user):
+    """Whether the delete link of the message is shown to the user.
+
+    Uses the value set by Message.attach_delete_permissions in the view when available.
+    """
+    if hasattr(message, 'delete_allowed'):
+        return message.delete_allowed
+    if getattr(user, 'is_admin', False):
+        return True
+    return not getattr(message, 'deleted', False) and message.can_be_deleted_by(user)
@@ -1,6 +1,20 @@
-from django.test import TestCase, override_settings
+import random
+import string
+import threading
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
 
-from ..models import PublicMessage, Room, User
+from django.contrib.auth.models import AnonymousUser
+from django.core.management import call_command
+from django.db import OperationalError, connection, connections
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from ..models import ConversationParticipant, PrivateMessage, PublicMessage, Room, RoomVisit, User
+from ..utils import InboxPage, ThreadPosition
+from ..visits import RoomVisitBuffer
 
 
 class TestDataMixin(object):
@@ -60,3 +74,326 @@ class TestModels(TestDataMixin, TestCase):
         for test in tests:
             message = PublicMessage.objects.create(room=self.room, author=self.user1, text=test['entered'])
             self.assertEqual(PublicMessage.objects.get(id=message.id).text, test['expected'])
+
+    def test_room_message_counters(self):
+        thread = PublicMessage.objects.create(room=self.room, author=self.user1, text="thread")
+        reply = PublicMessage.objects.create(room=self.room, author=self.user1, text="reply", thread=thread)
+        self.room.refresh_from_db()
+        self.assertEqual(self.room.total_messages, 2)
+        self.assertEqual(self.room.last_message_time, reply.created)
+
+        reply.delete()
+        self.room.refresh_from_db()
+        self.assertEqual(self.room.total_messages, 1)
+        self.assertEqual(self.room.last_message_time, thread.created)
+
+        PublicMessage.objects.create(room=self.room, author=self.user1, text="reply", thread=thread)
+        PublicMessage.objects.create(room=self.room, author=self.user1, text="reply", thread=thread)
+        # the thread takes its replies with it
+        thread.delete()
+        self.room.refresh_from_db()
+        self.assertEqual(self.room.total_messages, 0)
+        self.assertIsNone(self.room.last_message_time)
+
+    def test_room_message_counters_concurrent(self):
+        stale_room = Room.objects.get(pk=self.room.pk)
+        newer = PublicMessage.objects.create(room=self.room, author=self.user1, text="newer")
+        # committed after the newer one
+        with mock.patch("django.utils.timezone.now", return_value=newer.created - timedelta(seconds=1)):
+            PublicMessage.objects.create(room=self.room, author=self.user1, text="older")
+        stale_room.god_can_delete_posts = False
+        stale_room.save()
+        self.room.refresh_from_db()
+        self.assertEqual(self.room.total_messages, 2)
+        self.assertEqual(self.room.last_message_time, newer.created)
+        self.assertFalse(self.room.god_can_delete_posts)
+
+    def test_rebuild_counters_command(self):
+        PublicMessage.objects.create(room=self.room, author=self.user1, text="thread")
+        Room.objects.filter(pk=self.room.pk).update(total_messages=42, last_message_time=None)
+        call_command("rebuild_counters", stdout=StringIO())
+        self.room.refresh_from_db()
+        self.assertEqual(self.room.total_messages, 1)
+        self.assertIsNotNone(self.room.last_message_time)
+
+    def test_room_visit_new_messages(self):
+        visit = RoomVisit.objects.create(room=self.room, user=self.user1)
+        thread = PublicMessage.objects.create(room=self.room, author=self.user1, text="thread")
+        PublicMessage.objects.create(room=self.room, author=self.user1, text="reply", thread=thread)
+        self.assertEqual(RoomVisit.objects.visits_for_user(self.user1), {self.room.id: 2})
+
+        thread.delete()
+        self.assertEqual(RoomVisit.objects.visits_for_user(self.user1), {self.room.id: 0})
+
+        PublicMessage.objects.create(room=self.room, author=self.user1, text="thread")
+        RoomVisit.objects.filter(pk=visit.pk).update(new_messages=42)
+        call_command("rebuild_counters", stdout=StringIO())
+        self.assertEqual(RoomVisit.objects.visits_for_user(self.user1), {self.room.id: 1})
+
+    def test_room_visit_new_messages_delete(self):
+        user2 = User.objects.create(username="testclient2")
+        thread = PublicMessage.objects.create(room=self.room, author=self.user1, text="thread")
+        reply = PublicMessage.objects.create(room=self.room, author=self.user1, text="reply", thread=thread)
+        RoomVisit.objects.create(room=self.room, user=self.user1, visit_time=thread.created - timedelta(seconds=1),
+                                 new_messages=2)
+        RoomVisit.objects.create(room=self.room, user=user2, visit_time=reply.created)
+        PublicMessage.objects.create(room=self.room, author=self.user1, text="newest", thread=thread)
+
+        # only visits older than the deleted reply count it
+        reply.delete()
+        self.assertEqual(RoomVisit.objects.visits_for_user(self.user1), {self.room.id: 2})
+        self.assertEqual(RoomVisit.objects.visits_for_user(user2), {self.room.id: 1})
+
+        thread.delete()
+        self.assertEqual(RoomVisit.objects.visits_for_user(self.user1), {self.room.id: 0})
+        self.assertEqual(RoomVisit.objects.visits_for_user(user2), {self.room.id: 0})
+        self.room.refresh_from_db()
+        self.assertEqual((self.room.total_messages, self.room.last_message_time), (0, None))
+
+    def test_room_visit_buffer(self):
+        buffer = RoomVisitBuffer()
+        user2 = User.objects.create(username="testclient2")
+        first_visit = timezone.now()
+        buffer.record(self.user1.pk, self.room.pk, first_visit)
+        buffer.record(user2.pk, self.room.pk, first_visit)
+        PublicMessage.objects.create(room=self.room, author=self.user1, text="thread")
+        self.assertEqual(buffer.last_visit(self.user1.pk, self.room), (first_visit, 1))
+        buffer.record(self.user1.pk, self.room.pk)
+        self.assertEqual(buffer.discard(user2.pk, self.room.pk), True)
+
+        # the upsert in its savepoint
+        with self.assertNumQueries(3):
+            buffer.flush()
+        visit = RoomVisit.objects.get()
+        self.assertEqual((visit.user_id, visit.new_messages), (self.user1.pk, 0))
+
+        # older visits don't move the visit time back
+        buffer.record(self.user1.pk, self.room.pk, first_visit)
+        buffer.flush()
+        self.assertEqual(RoomVisit.objects.get().visit_time, visit.visit_time)
+
+    def test_room_visit_buffer_failed_flush(self):
+        buffer = RoomVisitBuffer()
+        buffer.record(self.user1.pk, self.room.pk)
+        with mock.patch.object(RoomVisit.objects, "upsert_visits", side_effect=OperationalError("deadlock detected")), \
+                self.assertLogs("phorum.visits", "ERROR"):
+            buffer.flush()
+        # the transaction can go on and the visits are written by the next flush
+        self.assertFalse(RoomVisit.objects.exists())
+        buffer.flush()
+        self.assertEqual(RoomVisit.objects.get().user_id, self.user1.pk)
+
+    def test_room_visit_buffer_processes(self):
+        # buffers of two worker processes sharing the cache
+        buffer, other = RoomVisitBuffer(), RoomVisitBuffer()
+        buffer.cache.clear()
+        visit_time = timezone.now()
+        buffer.record(self.user1.pk, self.room.pk, visit_time)
+        self.assertEqual(other.last_visit(self.user1.pk, self.room), (visit_time, 0))
+        self.assertEqual(other.pending(self.user1.pk, [self.room.pk, self.room.pk + 1]), {self.room.pk: visit_time})
+
+        # room marked unread in the other process
+        self.assertEqual(other.discard(self.user1.pk, self.room.pk), True)
+        buffer.flush()
+        self.assertFalse(RoomVisit.objects.exists())
+
+        # newer visit of the other process is written by both
+        buffer.record(self.user1.pk, self.room.pk, visit_time)
+        other.record(self.user1.pk, self.room.pk)
+        buffer.flush()
+        self.assertEqual(RoomVisit.objects.get().visit_time, other.pending(self.user1.pk, [self.room.pk])[self.room.pk])
+
+        # visits which outlived their key could undo a later mark as unread
+        RoomVisit.objects.all().delete()
+        buffer.record(self.user1.pk, self.room.pk, visit_time - timedelta(days=2))
+        buffer.cache.clear()
+        buffer.flush()
+        self.assertFalse(RoomVisit.objects.exists())
+        buffer.record(self.user1.pk, self.room.pk, visit_time)
+        buffer.cache.clear()
+        buffer.flush()
+        self.assertEqual(RoomVisit.objects.get().visit_time, visit_time)
+
+    def test_inbox_unread(self):
+        user2 = User.objects.create(username="testclient2")
+        thread = PrivateMessage.objects.create(author=self.user1, recipient=user2, text="thread")
+        PrivateMessage.objects.create(author=user2, recipient=self.user1, text="reply", thread=thread)
+        self.assertEqual(User.objects.get(pk=user2.pk).inbox_unread, 2)
+
+        user2.update_inbox_visit_time()
+        PrivateMessage.objects.create(author=self.user1, recipient=user2, text="thread")
+        self.assertEqual(User.objects.get(pk=user2.pk).inbox_unread, 1)
+
+        thread.delete()
+        self.assertEqual(User.objects.get(pk=self.user1.pk).inbox_unread, 1)
+        self.assertEqual(User.objects.get(pk=user2.pk).inbox_unread, 1)
+
+        User.objects.update(inbox_unread=42)
+        call_command("rebuild_counters", stdout=StringIO())
+        self.assertEqual(User.objects.get(pk=self.user1.pk).inbox_unread, 1)
+        self.assertEqual(User.objects.get(pk=user2.pk).inbox_unread, 1)
+
+    def test_conversation_participants(self):
+        user2 = User.objects.create(username="testclient2")
+
+        def participants(thread):
+            return {p.user_id: p.last_reply for p in thread.participants.all()}
+
+        thread = PrivateMessage.objects.create(author=self.user1, recipient=user2, text="thread")
+        self.assertEqual(participants(thread), {self.user1.pk: thread.created, user2.pk: thread.created})
+
+        reply = PrivateMessage.objects.create(author=user2, recipient=self.user1, text="reply", thread=thread)
+        self.assertEqual(participants(thread), {self.user1.pk: reply.created, user2.pk: reply.created})
+
+        reply.delete()
+        self.assertEqual(participants(thread), {self.user1.pk: thread.created, user2.pk: thread.created})
+
+        own = PrivateMessage.objects.create(author=self.user1, recipient=self.user1, text="note")
+        self.assertEqual(participants(own), {self.user1.pk: own.created})
+
+        thread.delete()
+        self.assertFalse(ConversationParticipant.objects.filter(thread_id=thread.pk).exists())
+
+    def test_thread_delete_kredyti(self):
+        user2 = User.objects.create(username="testclient2", kredyti=1)
+        User.objects.filter(pk=self.user1.pk).update(kredyti=20)
+
+        def delete_thread(replies):
+            thread = PublicMessage.objects.create(room=self.room, author=self.user1, text="thread")
+            for i in range(replies):
+                PublicMessage.objects.create(room=self.room, author=(self.user1, user2)[i % 2], text="reply",
+                                             thread=thread)
+            with CaptureQueriesContext(connection) as queries:
+                thread.delete()
+            return len(queries)
+
+        self.assertEqual(delete_thread(2), delete_thread(20))
+        self.assertEqual(User.objects.get(pk=self.user1.pk).kredyti, 20 - 1 - 10)
+        self.assertEqual(User.objects.get(pk=user2.pk).kredyti, 0)
+
+    def test_text_folded(self):
+        message = PublicMessage.objects.create(room=self.room, author=self.user1, text="Žluťoučký\nkůň")
+        message = PublicMessage.objects.get(id=message.id)
+        self.assertEqual(message.text, "Žluťoučký<br>kůň")
+        self.assertEqual(message.text_folded, "Zlutoucky<br>kun")
+        # letters which don't decompose, one letter each
+        message = PublicMessage.objects.create(room=self.room, author=self.user1, text="Łódź Øresund Straße")
+        self.assertEqual(message.text_folded, "Lodz Oresund Strase")
+
+    def test_fill_text_folded_command(self):
+        message = PublicMessage.objects.create(room=self.room, author=self.user1, text="kůň")
+        PublicMessage.objects.filter(pk=message.pk).update(text_folded="")
+        call_command("fill_text_folded", batch_size=1, stdout=StringIO())
+        self.assertEqual(PublicMessage.objects.get(id=message.id).text_folded, "kun")
+
+    def test_attach_delete_permissions(self):
+        god = User.objects.create(username="god", level_override=User.LEVEL_GOD)
+        moderator = User.objects.create(username="moderator")
+        admin = User.objects.create(username="admin", level_override=User.LEVEL_ADMIN)
+        room = Room.objects.create(name="moderated", moderator=moderator, god_can_delete_posts=True)
+        thread = PublicMessage.objects.create(room=room, author=self.user1, text="thread")
+        reply = PublicMessage.objects.create(room=room, author=god, text="reply", thread=thread)
+        deleted = PublicMessage.objects.create(room=room, author=self.user1, text="deleted", thread=thread)
+        deleted.delete_by(self.user1)
+
+        for user in (AnonymousUser(), self.user1, god, moderator, admin):
+            thread = PublicMessage.objects.select_related("author", "room").get(pk=thread.pk)
+            thread.child_messages = list(thread.children.select_related("author", "room"))
+            with self.assertNumQueries(0):
+                PublicMessage.attach_delete_permissions([thread], user)
+            for message in [thread] + thread.child_messages:
+                expected = getattr(user, "is_admin", False) or \
+                    not message.deleted and message.can_be_deleted_by(user)
+                self.assertEqual(message.delete_allowed, expected, (user, message.text))
+
+
+class LastReplyConcurrencyTest(TransactionTestCase):
+    def test_concurrent_replies(self):
+        user = User.objects.create(username="testclient1")
+        room = Room.objects.create(name="room")
+        thread = PublicMessage.objects.create(room=room, author=user, text="thread")
+        barrier = threading.Barrier(8)
+        replies = []
+
+        def reply():
+            try:
+                barrier.wait()
+                replies.append(PublicMessage.objects.create(room=room, author=user, text="reply", thread=thread))
+            finally:
+                connections.close_all()
+
+        workers = [threading.Thread(target=reply) for _ in range(8)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        self.assertEqual(len(replies), 8)
+        thread.refresh_from_db()
+        self.assertEqual(thread.last_reply, max(reply.created for reply in replies))
+
+        newest = max(replies, key=lambda reply: reply.created)
+        newest.delete()
+        thread.refresh_from_db()
+        self.assertEqual(thread.last_reply, max(reply.created for reply in replies if reply != newest))
+
+
+class QueryPlanTest(TestCase):
+    """Hot queries have to be served by the indexes made for them."""
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = User.objects.bulk_create(User(username="user%d" % i) for i in range(50))
+        cls.rooms = [Room.objects.create(name="room %d" % i) for i in range(50)]
+        now = timezone.now()
+        # most of the messages are replies
+        threads = PublicMessage.objects.bulk_create(
+            PublicMessage(room=cls.rooms[i % 50], author=cls.users[i % 50], created=now, last_reply=now)
+            for i in range(1000))
+        PublicMessage.objects.bulk_create(
+            PublicMessage(room=threads[i % 1000].room, author=cls.users[i % 50], thread=threads[i % 1000],
+                          text=cls.random_text(i), created=now)
+            for i in range(10000))
+        private_threads = PrivateMessage.objects.bulk_create(
+            PrivateMessage(author=cls.users[i % 50], recipient=cls.users[i * 7 % 50], created=now, last_reply=now)
+            for i in range(1000))
+        PrivateMessage.objects.bulk_create(
+            PrivateMessage(author=thread.recipient, recipient=thread.author, thread=thread, created=now)
+            for thread in private_threads * 10)
+        ConversationParticipant.objects.bulk_create(
+            ConversationParticipant(user_id=user_id, thread=thread, last_reply=now)
+            for thread in private_threads for user_id in {thread.author_id, thread.recipient_id})
+        with connection.cursor() as cursor:
+            # merge the rows waiting in the pending list into the GIN index like autovacuum does
+            cursor.execute("SELECT gin_clean_pending_list('publicmessage_text_folded_trgm')")
+            cursor.execute("ANALYZE phorum_publicmessage")
+            cursor.execute("ANALYZE phorum_privatemessage")
+            cursor.execute("ANALYZE phorum_conversationparticipant")
+
+    @staticmethod
+    def random_text(seed):
+        rng = random.Random(seed)
+        return " ".join("".join(rng.choice(string.ascii_lowercase) for _ in range(6)) for _ in range(10))
+
+    def assertUsesIndex(self, queryset, index_name):
+        plan = queryset.explain()
+        self.assertIn(index_name, plan)
+        self.assertNotIn("Seq Scan", plan)
+
+    def test_room_threads(self):
+        threads = PublicMessage.objects.filter(room=self.rooms[0], thread=None).order_by("-last_reply", "-id")
+        self.assertUsesIndex(threads[:10], "publicmessage_room_threads")
+
+    def test_room_new_messages(self):
+        messages = PublicMessage.objects.filter(room=self.rooms[0], created__gt=timezone.now()).values("id")
+        self.assertUsesIndex(messages, "publicmessage_room_created")
+
+    def test_inbox_threads(self):
+        page = InboxPage(PrivateMessage.objects.all(), self.users[0], 10)
+        self.assertEqual(len(page), 10)
+        for before in (None, ThreadPosition(page.object_list[-1].last_reply, page.object_list[-1].pk)):
+            self.assertUsesIndex(page.conversation_ids(11, before), "conversation_user_threads")
+
+    def test_search(self):
+        messages = PublicMessage.objects.filter(deleted_by=None, text_folded__iregex=self.random_text(42)[:20])
+        self.assertEqual(messages.count(), 1)
+        self.assertUsesIndex(messages, "publicmessage_text_folded_trgm")
@@ -1,6 +1,19 @@
-from django.test import SimpleTestCase
+from datetime import datetime
+from unittest import mock
 
-from ..utils import parse_search_query, build_token_pattern, build_search_patterns, SearchToken
+from django.conf import settings
+from django.core.cache import caches
+from django.test import SimpleTestCase, override_settings
+
+from ..cache import LRUCache
+from ..checks import shared_caches_check
+from ..instrumentation import Histogram
+from ..presence import PresenceTracker
+from ..templatetags.score_tags import compile_highlight_pattern, highlight
+from ..utils import (
+    is_ranked_search, parse_search_query, build_token_pattern, build_search_patterns, build_tsquery, SearchToken,
+    ThreadMatch
+)
 
 
 class UtilsTest(SimpleTestCase):
@@ -87,3 +100,165 @@ class UtilsTest(SimpleTestCase):
             build_search_patterns('"cat*" dog*'),
             [r'\ycat\*\y', r'\ydog\S*']
         )
+
+    def test_build_tsquery(self):
+        self.assertEqual(build_tsquery(parse_search_query('cat')), ("('cat')", []))
+        self.assertEqual(build_tsquery(parse_search_query('cat dog*')), ("('cat') & ('dog':*)", []))
+        self.assertEqual(build_tsquery(parse_search_query('"cat chases"')), ("('cat' <-> 'chases')", []))
+
+        # Quotes are escaped
+        self.assertEqual(build_tsquery(parse_search_query("it's")), ("('it''s')", []))
+
+        # Leading and internal wildcards are left for the regex lookup
+        self.assertEqual(
+            build_tsquery(parse_search_query('*cat do*g dog')),
+            ("('dog')", [SearchToken('*cat', False), SearchToken('do*g', False)])
+        )
+        self.assertEqual(build_tsquery(parse_search_query('*cat')), (None, [SearchToken('*cat', False)]))
+
+    def test_thread_match_cursor(self):
+        match = ThreadMatch(5, datetime(2024, 1, 1), 0.5)
+        self.assertEqual(ThreadMatch.from_cursor(match.cursor, ranked=True), match)
+        self.assertEqual(ThreadMatch.from_cursor(match._replace(rank=None).cursor, ranked=False),
+                         match._replace(rank=None))
+        # cursors of the other search ordering, e.g. after the engine was switched
+        with self.assertRaises(ValueError):
+            ThreadMatch.from_cursor(match.cursor, ranked=False)
+        with self.assertRaises(ValueError):
+            ThreadMatch.from_cursor(match._replace(rank=None).cursor, ranked=True)
+
+    @override_settings(SEARCH_ENGINE="fulltext")
+    def test_is_ranked_search(self):
+        self.assertTrue(is_ranked_search('cat *dog'))
+        self.assertFalse(is_ranked_search('*cat'))
+        with override_settings(SEARCH_ENGINE="regex"):
+            self.assertFalse(is_ranked_search('cat'))
+
+
+class LRUCacheTest(SimpleTestCase):
+    def test_eviction(self):
+        cache = LRUCache(max_size=2, ttl=60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        # 'b' is the least recently used one
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(cache.stats(), {'hits': 3, 'misses': 1, 'size': 2})
+
+    def test_ttl(self):
+        cache = LRUCache(max_size=2, ttl=60)
+        with mock.patch('phorum.cache.time.monotonic', return_value=100):
+            cache.set('a', 1)
+        with mock.patch('phorum.cache.time.monotonic', return_value=161):
+            self.assertIsNone(cache.get('a'))
+
+    def test_invalidate(self):
+        cache = LRUCache(max_size=10, ttl=60)
+        cache.set('a', 1, tags=(1, 2))
+        cache.set('b', 2, tags=(2,))
+        cache.set('c', 3, tags=(3,))
+        cache.invalidate(2)
+        self.assertIsNone(cache.get('a'))
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get_or_set('c', lambda: 42), 3)
+        self.assertEqual(cache.get_or_set('d', lambda: 42), 42)
+        self.assertEqual(cache.get('d'), 42)
+
+
+@override_settings(ACTIVE_USERS_TIMEOUT=5)
+class PresenceTrackerTest(SimpleTestCase):
+    def setUp(self):
+        caches['presence'].clear()
+        self.tracker = PresenceTracker(bucket_size=60)
+
+    def test_sliding_window(self):
+        with mock.patch('phorum.presence.time.time', return_value=6000):
+            self.tracker.record(1, {'name': "room"})
+            self.tracker.record(2)
+        with mock.patch('phorum.presence.time.time', return_value=6000 + 4 * 60):
+            self.tracker.record(1)
+            self.assertEqual(self.tracker.active_users(), {1: None, 2: None})
+        with mock.patch('phorum.presence.time.time', return_value=6000 + 6 * 60):
+            self.assertEqual(self.tracker.active_users(), {1: None})
+            self.tracker.remove(1)
+            self.assertEqual(self.tracker.active_count(), 0)
+
+    def test_processes_share_buckets(self):
+        other_process = PresenceTracker(bucket_size=60)
+        with mock.patch('phorum.presence.time.time', return_value=6000):
+            self.tracker.record(1)
+            other_process.record(2)
+            other_process.record(1, {'name': "room"})
+            self.assertEqual(self.tracker.active_users(), {1: {'name': "room"}, 2: None})
+            self.assertEqual(caches['presence'].get(self.tracker.count_key(100)), 2)
+
+    def test_cache_down(self):
+        # the presence cache of production.py with nothing listening
+        down = {'BACKEND': 'django.core.cache.backends.memcached.PyMemcacheCache', 'LOCATION': '127.0.0.1:1',
+                'OPTIONS': {'ignore_exc': True, 'connect_timeout': 0.5, 'timeout': 0.5}}
+        with override_settings(CACHES=dict(settings.CACHES, presence=down)):
+            self.tracker.record(1, {'name': "room"})
+            self.assertEqual(self.tracker.active_users(), {})
+        # the counter lost between adding the user and counting them
+        with mock.patch.object(caches['presence'], 'incr', side_effect=ValueError):
+            self.tracker.record(1)
+        self.assertEqual(self.tracker.active_users(), {})
+
+
+class SharedCachesCheckTest(SimpleTestCase):
+    def test_process_local_cache(self):
+        local = {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}
+        shared = {'BACKEND': 'django.core.cache.backends.memcached.PyMemcacheCache', 'LOCATION': '127.0.0.1:11211'}
+        # presence cache keeps the room visits too
+        with override_settings(DEBUG=False, CACHES={'default': shared, 'presence': local, 'sessions': shared}):
+            self.assertEqual([error.id for error in shared_caches_check(None)], ['phorum.E001'] * 2)
+        with override_settings(DEBUG=False, ROOM_VISIT_CACHE='visits',
+                               CACHES={'default': shared, 'presence': shared, 'sessions': shared, 'visits': local}):
+            self.assertEqual([error.id for error in shared_caches_check(None)], ['phorum.E001'])
+        with override_settings(DEBUG=False, CACHES={'default': shared, 'presence': shared, 'sessions': local}):
+            self.assertEqual([error.id for error in shared_caches_check(None)], ['phorum.E001'])
+        with override_settings(DEBUG=True, CACHES={'default': local, 'presence': local, 'sessions': local}):
+            self.assertEqual(shared_caches_check(None), [])
+        with override_settings(DEBUG=False, CACHES={'default': local, 'presence': shared, 'sessions': shared}):
+            self.assertEqual([error.id for error in shared_caches_check(None)], ['phorum.E001'])
+        with override_settings(DEBUG=False, CACHES={'default': shared, 'presence': shared, 'sessions': shared}):
+            self.assertEqual(shared_caches_check(None), [])
+
+
+class HistogramTest(SimpleTestCase):
+    def test_buckets(self):
+        histogram = Histogram((1, 10))
+        for value in (0, 1, 5, 10, 11, 100):
+            histogram.observe(value)
+        self.assertEqual(histogram.snapshot(), {
+            'buckets': {1: 2, 10: 2, float("inf"): 2},
+            'count': 6,
+            'sum': 127,
+        })
+
+
+class HighlightSearchTest(SimpleTestCase):
+    def test_highlight(self):
+        self.assertEqual(highlight('Kočka a pes', 'kocka'), '<mark class="search-highlight">Kočka</mark> a pes')
+        self.assertEqual(
+            highlight('kokos a koko', 'koko pes'),
+            'kokos a <mark class="search-highlight">koko</mark>'
+        )
+        self.assertEqual(
+            highlight('velký koš<br>koše', '*koš*'),
+            'velký <mark class="search-highlight">koš</mark><br><mark class="search-highlight">koše</mark>'
+        )
+
+    def test_highlight_skips_tags(self):
+        text = '<a href="http://example.com/koko">koko</a>'
+        self.assertEqual(
+            highlight(text, 'koko'),
+            '<a href="http://example.com/koko"><mark class="search-highlight">koko</mark></a>'
+        )
+
+    def test_highlight_pattern_cached(self):
+        self.assertIs(compile_highlight_pattern('"cat chases" dog*'), compile_highlight_pattern('"cat chases" dog*'))
+        self.assertIsNone(compile_highlight_pattern('   '))
@@ -3,25 +3,44 @@ import os
 import random
 import re
 import string
+import time
 from datetime import datetime, timedelta
 from unittest import mock
+from urllib.parse import quote
 
 from autoslug.utils import slugify
 from django.conf import settings
 from django.contrib.auth import SESSION_KEY
 from django.contrib.auth.hashers import get_hasher
+from django.core.cache import caches
+from django.db import connection
 from django.db.models.fields.files import FieldFile
 from django.http import HttpResponse
-from django.test import TestCase, override_settings
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from django.utils import timezone
+from qsessions.models import Session
 
 from phorum.models.utils import  css_upload_path, js_upload_path
 from .utils import new_public_thread, public_reply
+from ..context_processors import inbox_messages
+from ..instrumentation import view_stats, QueryBudgetExceeded
+from ..utils import is_ranked_search, keyring_cache, room_cache, room_cache_version, search_cache
+from ..visits import room_visits
 from ..models import PrivateMessage, PublicMessage, Room, RoomVisit, User, UserRoomKeyring, UserCustomization
 
 
 class TestDataMixin(object):
+    def setUp(self):
+        # cached keyrings and rooms would outlive the rolled back test data
+        keyring_cache.clear()
+        room_cache.clear()
+        room_visits.clear()
+        room_visits.cache.clear()
+        # buffered visits of the rolled back test data must not be written at exit
+        self.addCleanup(room_visits.clear)
+
     @classmethod
     def setUpTestData(cls):
         pw_hasher = get_hasher()
@@ -160,6 +179,56 @@ class RoomViewTest(TestDataMixin, TestCase):
                                     data)
         self.assertRedirects(response, reverse("room_view", kwargs={'room_slug': self.rooms['protected'].slug}))
 
+    def test_password_prompt_keyring_upsert(self):
+        room = self.rooms['protected']
+        url = reverse("room_password_prompt", kwargs={'room_slug': room.slug})
+        assert self.client.login(username="testclient1", password="password")
+        self.client.post(url, {'password': "password"})
+        first_entry = UserRoomKeyring.objects.get(room=room, user=self.user1).last_successful_entry
+        with CaptureQueriesContext(connection) as queries:
+            self.client.post(url, {'password': "password"})
+        keyring_queries = [query for query in queries if UserRoomKeyring._meta.db_table in query['sql']]
+        self.assertEqual(len(keyring_queries), 1)
+        self.assertGreater(UserRoomKeyring.objects.get(room=room, user=self.user1).last_successful_entry, first_entry)
+
+    @override_settings(ROOM_VISIT_BATCH_SIZE=2, ROOM_VISIT_FLUSH_INTERVAL=3600)
+    def test_room_visits_written_behind(self):
+        room = self.rooms['unpinned1']
+        url = reverse("room_view", kwargs={'room_slug': room.slug})
+        assert self.client.login(username="testclient1", password="password")
+        self.client.get(url)
+        first_visit = room_visits.pending(self.user1.pk, [room.pk])[room.pk]
+        new_public_thread(room, self.user2)
+        # the visit is not written yet, but seen by the user
+        response = self.client.get(url)
+        self.assertFalse(RoomVisit.objects.filter(user=self.user1).exists())
+        self.assertEqual(response.context['new_posts'], 1)
+        self.assertEqual(response.context['last_visit_time'], first_visit)
+        response = self.client.get(reverse("home"))
+        self.assertEqual(response.context['visits'], {room.pk: 0})
+
+        # the second room fills the batch
+        self.client.get(reverse("room_view", kwargs={'room_slug': self.rooms['unpinned2'].slug}))
+        self.assertEqual(RoomVisit.objects.filter(user=self.user1).count(), 2)
+        visit = RoomVisit.objects.get(user=self.user1, room=room)
+        self.assertEqual(visit.visit_time, room_visits.pending(self.user1.pk, [room.pk])[room.pk])
+        self.assertEqual(visit.new_messages, 0)
+
+    def test_protected_room_access_cached(self):
+        room = self.rooms['protected']
+        assert self.client.login(username="testclient1", password="password")
+        self.client.post(reverse("room_password_prompt", kwargs={'room_slug': room.slug}), {'password': "password"})
+        self.client.get(reverse("room_view", kwargs={'room_slug': room.slug}))
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse("room_view", kwargs={'room_slug': room.slug}))
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse([query for query in queries if UserRoomKeyring._meta.db_table in query['sql']])
+
+        room.set_password("new password")
+        room.save()
+        response = self.client.get(reverse("room_view", kwargs={'room_slug': room.slug}))
+        self.assertRedirects(response, reverse("room_password_prompt", kwargs={'room_slug': room.slug}))
+
     def test_password_prompt_rejects_invalid(self):
         assert self.client.login(username="testclient1", password="password")
         data = {
@@ -179,6 +248,35 @@ class RoomViewTest(TestDataMixin, TestCase):
         response = self.client.get(reverse("room_view", kwargs=room_kwargs), data={'page': "1x"})
         self.assertEqual(response.status_code, 404)
 
+    def test_room_keyset_pagination(self):
+        room = self.rooms['unpinned1']
+        threads = [new_public_thread(room, self.user1, text="thread %d" % i) for i in range(15)]
+        # ties in last_reply are broken by id
+        PublicMessage.objects.filter(pk__in=[t.pk for t in threads[:8]]).update(last_reply=threads[0].created)
+        assert self.client.login(username="testclient1", password="password")
+        room_url = reverse("room_view", kwargs={'room_slug': room.slug})
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(room_url)
+        self.assertFalse([query for query in queries if "COUNT(" in query['sql']])
+        page = response.context['threads']
+        self.assertEqual(len(page), 10)
+        self.assertTrue(page.has_next)
+        self.assertContains(response, "?before=%s&page=2" % quote(page.next_cursor))
+
+        response = self.client.get(room_url, {'before': page.next_cursor, 'page': 2})
+        next_page = response.context['threads']
+        self.assertEqual(len(next_page), 5)
+        self.assertFalse(next_page.has_next)
+        self.assertEqual({t.pk for t in page} | {t.pk for t in next_page}, {t.pk for t in threads})
+        self.assertContains(response, "| stránka 2 |")
+
+    def test_room_invalid_cursor(self):
+        assert self.client.login(username="testclient1", password="password")
+        room_kwargs = {'room_slug': self.rooms['unpinned1'].slug}
+        response = self.client.get(reverse("room_view", kwargs=room_kwargs), data={'before': "nonsense"})
+        self.assertEqual(response.status_code, 404)
+
     def test_authenticated_can_create_thread(self):
         assert self.client.login(username="testclient1", password="password")
         room_kwargs = {'room_slug': self.rooms['unpinned1'].slug}
@@ -460,6 +558,51 @@ class RoomViewTest(TestDataMixin, TestCase):
         response = self.client.post(reverse("room_edit", kwargs={'room_slug': room.slug}), data)
         self.assertRedirects(response, reverse("room_view", kwargs={'room_slug': room.slug}))
 
+    def test_room_cache(self):
+        room = Room.objects.create(name="cached room", author=self.user1)
+        thread = new_public_thread(room, self.user2, text="cached thread")
+        public_reply(thread, self.user2, text="cached reply")
+        assert self.client.login(username="testclient1", password="password")
+        self.client.get(reverse("search"), {'q': 'cached'})
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse("search"), {'q': 'cached'})
+        self.assertContains(response, room.name)
+        # visible room ids are still queried, but no whole rooms
+        self.assertFalse([query for query in queries if '"phorum_room"."slug"' in query['sql']])
+
+        # the version is bumped by the save and again once the room is committed
+        version = room_cache_version()
+        with self.captureOnCommitCallbacks() as callbacks:
+            room.save()
+        saved_version = room_cache_version()
+        self.assertNotEqual(saved_version, version)
+        for callback in callbacks:
+            callback()
+        self.assertNotEqual(room_cache_version(), saved_version)
+
+    def test_room_view_cached(self):
+        room = Room.objects.create(name="cached room", author=self.user1)
+        thread = new_public_thread(room, self.user2, text="cached thread")
+        public_reply(thread, self.user2, text="cached reply")
+        assert self.client.login(username="testclient1", password="password")
+        room_url = reverse("room_view", kwargs={'room_slug': room.slug})
+        response = self.client.get(room_url)
+        # the first visit counts all messages of the room, not the counter of the cached room
+        self.assertEqual(response.context['new_posts'], 2)
+        # the version is only read to resolve the slug, messages of the page are from the room
+        with CaptureQueriesContext(connection) as queries, \
+                mock.patch("phorum.utils.room_cache_version", wraps=room_cache_version) as version:
+            self.client.get(room_url)
+        self.assertFalse([query for query in queries if '"phorum_room"."slug"' in query['sql']])
+        self.assertEqual(version.call_count, 1)
+
+        # password set in another process
+        stored = Room.objects.get(pk=room.pk)
+        stored.set_password("password")
+        stored.save()
+        response = self.client.get(room_url)
+        self.assertRedirects(response, reverse("room_password_prompt", kwargs={'room_slug': room.slug}))
+
     def test_moderator_can_not_edit_room(self):
         room = Room.objects.create(
             name="new room",
@@ -548,6 +691,7 @@ class RoomViewTest(TestDataMixin, TestCase):
         assert self.client.login(username="testclient1", password="password")
         room = self.rooms['unpinned1']
         self.client.get(reverse("room_view", kwargs={'room_slug': room.slug}))
+        room_visits.flush()
         self.assertEqual(RoomVisit.objects.filter(room=room, user=self.user1).count(), 1)
         response = self.client.get(reverse("room_mark_unread", kwargs={'room_slug': room.slug}))
         self.assertRedirects(response, reverse("home"), fetch_redirect_response=False)
@@ -555,6 +699,15 @@ class RoomViewTest(TestDataMixin, TestCase):
         self.assertEqual(RoomVisit.objects.filter(room=room, user=self.user1).count(), 0)
         self.assertContains(response,  "byla označena jako nepřečtená")
 
+    def test_mark_unread_pending(self):
+        assert self.client.login(username="testclient1", password="password")
+        room = self.rooms['unpinned1']
+        self.client.get(reverse("room_view", kwargs={'room_slug': room.slug}))
+        response = self.client.get(reverse("room_mark_unread", kwargs={'room_slug': room.slug}), follow=True)
+        self.assertContains(response, "byla označena jako nepřečtená")
+        room_visits.flush()
+        self.assertFalse(RoomVisit.objects.filter(room=room, user=self.user1).exists())
+
     def test_mark_unread_nonvisited(self):
         assert self.client.login(username="testclient1", password="password")
         room = self.rooms['unpinned1']
@@ -564,6 +717,27 @@ class RoomViewTest(TestDataMixin, TestCase):
         self.assertNotContains(response, "byla označena jako nepřečtená")
         self.assertEqual(RoomVisit.objects.filter(room=room, user=self.user1).count(), 0)
 
+    def test_rendered_messages_cached(self):
+        caches['messages'].clear()
+        room = self.rooms['unpinned1']
+        message = new_public_thread(room, self.user2, text="original text")
+        assert self.client.login(username="testclient1", password="password")
+        # first visit renders the message as new
+        self.client.get(reverse("room_view", kwargs={'room_slug': room.slug}))
+        self.client.get(reverse("room_view", kwargs={'room_slug': room.slug}))
+
+        # unchanged message is not rendered again
+        PublicMessage.objects.filter(pk=message.pk).update(text="changed text")
+        response = self.client.get(reverse("room_view", kwargs={'room_slug': room.slug}))
+        self.assertContains(response, "original text")
+
+        # author's profile change invalidates it
+        self.user2.level_override = User.LEVEL_GOD
+        self.user2.save()
+        response = self.client.get(reverse("room_view", kwargs={'room_slug': room.slug}))
+        self.assertContains(response, "changed text")
+        self.assertContains(response, "level-%d" % User.LEVEL_GOD)
+
 
 @override_settings(USE_TZ=False)
 class InboxText(TestDataMixin, TestCase):
@@ -586,6 +760,28 @@ class InboxText(TestDataMixin, TestCase):
         self.assertContains(response, thread.text)
         self.assertContains(response, reply.text)
 
+    def test_inbox_keyset_pagination(self):
+        threads = [
+            PrivateMessage.objects.create(author=author, recipient=recipient, text="thread")
+            for author, recipient in [(self.user1, self.user2), (self.user2, self.user1), (self.user1, self.user1),
+                                      (self.user2, self.user3)] * 5
+        ]
+        inbox_threads = {t.pk for t in threads if self.user1.pk in (t.author_id, t.recipient_id)}
+        assert self.client.login(username="testclient1", password="password")
+        response = self.client.get(reverse("inbox"))
+        page = response.context['threads']
+        self.assertEqual(len(page), 10)
+        self.assertTrue(page.has_next)
+
+        # user, conversation ids, threads, authors, recipients, replies, customization and inbox visit time
+        with self.assertNumQueries(8):
+            response = self.client.get(reverse("inbox"), {'before': page.next_cursor, 'page': 2})
+        next_page = response.context['threads']
+        self.assertEqual(len(next_page), 5)
+        self.assertFalse(next_page.has_next)
+        self.assertEqual([t.pk for t in page] + [t.pk for t in next_page],
+                         sorted(inbox_threads, reverse=True))
+
     def test_inbox_unread_count(self):
         self._create_test_messages()
         assert self.client.login(username="testclient1", password="password")
@@ -606,6 +802,13 @@ class InboxText(TestDataMixin, TestCase):
         response = self.client.get(reverse("home"))
         self.assertContains(response, '<span class="inbox-new-messages">0</span>')
 
+    def test_inbox_unread_count_without_query(self):
+        self._create_test_messages()
+        request = RequestFactory().get(reverse("home"))
+        request.user = User.objects.get(pk=self.user1.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(inbox_messages(request), {'inbox_unread_count': 2})
+
     def test_can_send_message(self):
         assert self.client.login(username="testclient1", password="password")
         data = {
@@ -805,6 +1008,37 @@ class ThreadViewTest(TestDataMixin, TestCase):
         self.assertContains(response, "reply_2_text")
 
 
+@override_settings(USE_TZ=False)
+class InstrumentationTest(TestDataMixin, TestCase):
+    def setUp(self):
+        super(InstrumentationTest, self).setUp()
+        view_stats.clear()
+
+    def test_server_timing(self):
+        assert self.client.login(username="testclient1", password="password")
+        room = self.rooms['unpinned1']
+        new_public_thread(room, self.user2)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse("room_view", kwargs={'room_slug': room.slug}))
+        timing = dict(re.findall(r'(\w+);dur=[\d.]+(?:;desc="(\d+) queries")?', response['Server-Timing']))
+        self.assertEqual(timing['db'], str(len(queries)))
+        self.assertIn('tpl', timing)
+        self.assertIn('total', timing)
+
+        stats = view_stats.snapshot()['room_view']
+        self.assertEqual(stats['queries']['count'], 1)
+        self.assertEqual(stats['queries']['sum'], len(queries))
+        self.assertEqual(stats['response_size']['sum'], len(response.content))
+
+    def test_query_budget(self):
+        with override_settings(QUERY_BUDGETS={'room_list': 1}):
+            with self.assertRaisesMessage(QueryBudgetExceeded, "View room_list executed"):
+                self.client.get(reverse("home"))
+            with override_settings(QUERY_BUDGET_ACTION="log"), self.assertLogs("phorum.middleware", "WARNING"):
+                response = self.client.get(reverse("home"))
+        self.assertEqual(response.status_code, 200)
+
+
 @override_settings(USE_TZ=False)
 class AuthenticationTest(TestDataMixin, TestCase):
 
@@ -825,6 +1059,49 @@ class AuthenticationTest(TestDataMixin, TestCase):
         self.assertRedirects(response, reverse("home"), fetch_redirect_response=True)
         self.assertNotIn(SESSION_KEY, self.client.session)
 
+    def test_active_users(self):
+        caches['presence'].clear()
+        room = self.rooms['unpinned1']
+        assert self.client.login(username="testclient1", password="password")
+        self.client.get(reverse("room_view", kwargs={'room_slug': room.slug}))
+        assert self.client.login(username="testclient2", password="password")
+        response = self.client.get(reverse("users"))
+        self.assertContains(response, '<td class="user">testclient1</td>')
+        self.assertContains(response, '<td class="user">testclient2</td>')
+        self.assertContains(response, '<a href="%s">%s</a>' % (reverse("room_view", kwargs={'room_slug': room.slug}),
+                                                               room.name))
+        self.assertEqual(response.context['active_users_count'], 2)
+
+    def test_logout_removes_active_user(self):
+        caches['presence'].clear()
+        assert self.client.login(username="testclient1", password="password")
+        self.client.get(reverse("home"))
+        self.client.get(reverse("logout"))
+        assert self.client.login(username="testclient2", password="password")
+        response = self.client.get(reverse("users"))
+        self.assertNotContains(response, '<td class="user">testclient1</td>')
+        self.assertEqual(response.context['active_users_count'], 1)
+
+    def test_session_saved_once_per_activity_interval(self):
+        assert self.client.login(username="testclient1", password="password")
+        self.client.get(reverse("home"))
+        session = Session.objects.get(session_key=self.client.session.session_key)
+        self.client.get(reverse("home"))
+        self.assertEqual(Session.objects.get(pk=session.pk).updated_at, session.updated_at)
+        with mock.patch('phorum.middleware.time.time', return_value=time.time() + 61):
+            self.client.get(reverse("home"))
+        self.assertGreater(Session.objects.get(pk=session.pk).updated_at, session.updated_at)
+
+    def test_session_read_from_cache(self):
+        assert self.client.login(username="testclient1", password="password")
+        self.client.get(reverse("home"))
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse("home"))
+        self.assertEqual(response.context['user'], self.user1)
+        self.assertFalse([query for query in queries if Session._meta.db_table in query['sql']])
+        session = Session.objects.get(session_key=self.client.session.session_key)
+        self.assertEqual(session.user, self.user1)
+
     def test_inactive_can_not_login(self):
         data = {
             'username': "inactive",
@@ -859,6 +1136,7 @@ class AuthenticationTest(TestDataMixin, TestCase):
 class UserManagementTest(TestDataMixin, TestCase):
 
     def setUp(self):
+        super(UserManagementTest, self).setUp()
         os.environ['RECAPTCHA_TESTING'] = "True"
 
     def tearDown(self):
@@ -1034,6 +1312,11 @@ class UserManagementTest(TestDataMixin, TestCase):
 @override_settings(USE_TZ=False)
 class SearchTest(TestDataMixin, TestCase):
 
+    def setUp(self):
+        super(SearchTest, self).setUp()
+        # cached results would outlive the rolled back test data
+        search_cache.clear()
+
     def test_search_page_loads(self):
         assert self.client.login(username="testclient1", password="password")
         response = self.client.get(reverse("search"))
@@ -1063,7 +1346,7 @@ class SearchTest(TestDataMixin, TestCase):
         # Text is highlighted - check for highlighted match
         self.assertContains(response, 'class="search-highlight">koko</mark> tyčka')
         # Should only find 1 result (koko tyčka), not 2 (kokos should be excluded)
-        self.assertEqual(response.context['page'].paginator.count, 1)
+        self.assertEqual(response.context['page'].count, 1)
 
     def test_search_wildcard(self):
         """'*kos' should find both 'kokos' and other matching words"""
@@ -1072,7 +1355,7 @@ class SearchTest(TestDataMixin, TestCase):
         new_public_thread(self.rooms['unpinned1'], self.user1, text="velkos")
 
         response = self.client.get(reverse("search"), {'q': '*kos'})
-        self.assertEqual(response.context['page'].paginator.count, 2)
+        self.assertEqual(response.context['page'].count, 2)
 
     def test_search_diacritics_insensitive(self):
         """'*kos' should find 'koš' (with háček)"""
@@ -1083,6 +1366,13 @@ class SearchTest(TestDataMixin, TestCase):
         # Text is highlighted, check for the highlighted match and rest of text
         self.assertContains(response, 'class="search-highlight">koš</mark> na prádlo')
 
+    def test_search_letters_without_decomposition(self):
+        assert self.client.login(username="testclient1", password="password")
+        new_public_thread(self.rooms['unpinned1'], self.user1, text="výlet do Łódźe")
+
+        response = self.client.get(reverse("search"), {'q': 'lodze'})
+        self.assertContains(response, 'class="search-highlight">Łódźe</mark>')
+
     def test_search_case_insensitive(self):
         assert self.client.login(username="testclient1", password="password")
         new_public_thread(self.rooms['unpinned1'], self.user1, text="Hello World")
@@ -1120,7 +1410,51 @@ class SearchTest(TestDataMixin, TestCase):
             new_public_thread(self.rooms['unpinned1'], self.user1, text=f"searchable text {i}")
 
         response = self.client.get(reverse("search"), {'q': 'searchable'})
-        self.assertTrue(response.context['page'].has_next())
+        page = response.context['page']
+        self.assertTrue(page.has_next)
+        self.assertEqual(page.count, 15)
+
+        # next page follows the last thread of the first one
+        response = self.client.get(reverse("search"), {'q': 'searchable', 'after': page.next_cursor, 'page': 2})
+        self.assertFalse(response.context['page'].has_next)
+        self.assertEqual(len(response.context['threads']), 5)
+        first_ids = {t.thread_id for t in page}
+        self.assertFalse(first_ids & {t.pk for t in response.context['threads']})
+
+    def test_search_results_cached(self):
+        assert self.client.login(username="testclient1", password="password")
+        new_public_thread(self.rooms['unpinned1'], self.user1, text="cached text")
+
+        self.client.get(reverse("search"), {'q': 'cached'})
+        misses = search_cache.misses
+        # same tokens in different case and order are served from the cache
+        with self.assertLogs("phorum.views", "DEBUG") as logs:
+            response = self.client.get(reverse("search"), {'q': 'CACHED'})
+        self.assertEqual(search_cache.misses, misses)
+        self.assertIn("hits=", logs.output[0])
+        self.assertNotIn('X-Search-Cache', response)
+
+        # new post in a visible room invalidates the results in all processes once it's committed
+        with self.captureOnCommitCallbacks() as callbacks:
+            new_public_thread(self.rooms['unpinned2'], self.user1, text="cached text again")
+        response = self.client.get(reverse("search"), {'q': 'cached'})
+        self.assertEqual(response.context['page'].count, 1)
+        for callback in callbacks:
+            callback()
+        response = self.client.get(reverse("search"), {'q': 'cached'})
+        self.assertEqual(response.context['page'].count, 2)
+
+    def test_search_invalid_cursor(self):
+        assert self.client.login(username="testclient1", password="password")
+        response = self.client.get(reverse("search"), {'q': 'searchable', 'after': 'nonsense'})
+        self.assertEqual(response.status_code, 404)
+
+    def test_search_cursor_of_other_engine(self):
+        assert self.client.login(username="testclient1", password="password")
+        ranked = is_ranked_search('searchable')
+        for cursor, ranked_cursor in (('2024-01-01T00:00:00,5', False), ('2024-01-01T00:00:00,5,1.0', True)):
+            response = self.client.get(reverse("search"), {'q': 'searchable', 'after': cursor, 'page': 2})
+            self.assertEqual(response.status_code, 200 if ranked == ranked_cursor else 404)
 
     def test_search_respects_user_page_size(self):
         assert self.client.login(username="testclient1", password="password")
@@ -1176,3 +1510,15 @@ class SearchTest(TestDataMixin, TestCase):
     def test_search_menu_link_not_shown_for_anonymous(self):
         response = self.client.get(reverse("home"))
         self.assertNotContains(response, 'href="/search"')
+
+
+@override_settings(USE_TZ=False, SEARCH_ENGINE="fulltext")
+class FulltextSearchTest(SearchTest):
+
+    def test_search_ranks_by_relevance(self):
+        assert self.client.login(username="testclient1", password="password")
+        relevant = new_public_thread(self.rooms['unpinned1'], self.user1, text="pivo pivo pivo")
+        new_public_thread(self.rooms['unpinned1'], self.user1, text="pivo a limonáda a čaj a káva")
+
+        response = self.client.get(reverse("search"), {'q': 'pivo'})
+        self.assertEqual(response.context['threads'][0], relevant)
@@ -1,22 +1,129 @@
 from collections import namedtuple
+from copy import copy
+from datetime import datetime
 import re
+import time
+import unicodedata
 
-from django.db.models import Q
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F, Q
+from django.http import Http404
+from django.utils.functional import cached_property
+
+from .cache import LRUCache
 
 
 SearchToken = namedtuple('SearchToken', ['text', 'is_phrase'])
 
+# text search configuration of PublicMessage.search_vector
+SEARCH_CONFIG = 'simple'
 
-def user_can_view_protected_room(user, room):
-    from .models import UserRoomKeyring
+# search results keyed with search versions of rooms visible to the searching user, see SearchPage
+search_cache = LRUCache(settings.SEARCH_CACHE_SIZE, settings.SEARCH_CACHE_TTL)
+
+SEARCH_VERSION_KEY = "phorum:search_version:%d"
+
+# room keyrings of users, tagged with ("user", user id) and ("room", room id) of each room in the keyring
+keyring_cache = LRUCache(settings.KEYRING_CACHE_SIZE, settings.KEYRING_CACHE_TTL)
+
+
+# rooms by ("slug", slug, version) and ("pk", id, version), see get_room
+room_cache = LRUCache(settings.ROOM_CACHE_SIZE, settings.ROOM_CACHE_TTL)
+
+ROOM_CACHE_VERSION_KEY = "phorum:room_cache_version"
+
+
+def room_cache_version():
+    """Version of cached rooms, shared by the processes through the default cache."""
+    return cache.get_or_set(ROOM_CACHE_VERSION_KEY, time.time_ns, None)
+
+
+def bump_room_cache_version():
+    """Drop cached rooms in all processes now and once the current transaction commits.
+
+    A concurrent request could cache the room as it was before the commit
+    under the first version, the second one drops it.
+    """
+    cache.set(ROOM_CACHE_VERSION_KEY, time.time_ns(), None)
+    transaction.on_commit(lambda: cache.set(ROOM_CACHE_VERSION_KEY, time.time_ns(), None))
+
+
+def search_versions(room_ids):
+    """Versions of search results in the rooms, shared by the processes through the default cache."""
+    keys = [SEARCH_VERSION_KEY % room_id for room_id in room_ids]
+    versions = cache.get_many(keys)
+    missing = {key: time.time_ns() for key in keys if key not in versions}
+    if missing:
+        cache.set_many(missing, None)
+        versions.update(missing)
+    return tuple(versions[key] for key in keys)
+
+
+def bump_search_version(room_id):
+    """Drop cached search results in the room in all processes once the current transaction commits."""
+    transaction.on_commit(lambda: cache.set(SEARCH_VERSION_KEY % room_id, time.time_ns(), None))
+
+
+def get_room(version=None, **lookup):
+    """Get room by slug or pk from room_cache, raises Room.DoesNotExist.
+
+    Saving a room drops the cached rooms once the save is committed, but its
+    message counters are updated without saving the room, so they have to be
+    read from the database where they matter.
+    """
+    from .models import Room
+
+    (field, value), = lookup.items()
+    version = version or room_cache_version()
+    room = room_cache.get((field, value, version))
+    if room is None:
+        room = Room.objects.get(**lookup)
+        room_cache.set(("slug", room.slug, version), room)
+        room_cache.set(("pk", room.pk, version), room)
+    # the cached instance is shared by requests
+    return copy(room)
+
+
+def get_room_or_404(slug):
+    from .models import Room
 
     try:
-        record = UserRoomKeyring.objects.get(user=user, room=room)
-        if room.password_changed < record.last_successful_entry:
-            return True
-    except UserRoomKeyring.DoesNotExist:
-        return False
-    return False
+        return get_room(slug=slug)
+    except Room.DoesNotExist:
+        raise Http404("No Room matches the given query.")
+
+
+def attach_rooms(messages, room=None):
+    """Set room of PublicMessages from room_cache instead of fetching it with them."""
+    rooms = {room.pk: room} if room else {}
+    # messages of a single room don't need the cache
+    version = None if all(message.room_id in rooms for message in messages) else room_cache_version()
+    for message in messages:
+        if message.room_id not in rooms:
+            rooms[message.room_id] = get_room(version, pk=message.room_id)
+        message.room = rooms[message.room_id]
+
+
+def user_keyring(user, refresh=False):
+    """Get {room id: last successful entry} of rooms the user has unlocked."""
+    from .models import UserRoomKeyring
+
+    keyring = None if refresh else keyring_cache.get(user.pk)
+    if keyring is None:
+        keyring = dict(UserRoomKeyring.objects.filter(user=user).values_list('room_id', 'last_successful_entry'))
+        tags = [('user', user.pk)] + [('room', room_id) for room_id in keyring]
+        keyring_cache.set(user.pk, keyring, tags)
+    return keyring
+
+
+def user_can_view_protected_room(user, room):
+    last_entry = user_keyring(user).get(room.pk)
+    if last_entry is None or last_entry <= room.password_changed:
+        # the room could have been unlocked in another process since the keyring was cached
+        last_entry = user_keyring(user, refresh=True).get(room.pk)
+    return last_entry is not None and room.password_changed < last_entry
 
 
 def get_ip_addr(request):
@@ -33,6 +140,32 @@ def get_custom_resource_filename(user_id, resource_type):
            % dict(res_type=resource_type, user_id=user_id)
 
 
+class DiacriticsFolding(dict):
+    """Translation table stripping diacritics, filled in lazily for each character seen."""
+
+    # letters without a decomposition, folded to a single letter like unaccent() does (except ß, æ and œ)
+    letters = {
+        'Ł': 'L', 'ł': 'l', 'Ø': 'O', 'ø': 'o', 'Đ': 'D', 'đ': 'd', 'Ð': 'D', 'ð': 'd', 'Ħ': 'H', 'ħ': 'h',
+        'Ŧ': 'T', 'ŧ': 't', 'Ŀ': 'L', 'ŀ': 'l', 'ı': 'i', 'ß': 's', 'Æ': 'A', 'æ': 'a', 'Œ': 'O', 'œ': 'o',
+    }
+
+    def __missing__(self, char_code):
+        char = chr(char_code)
+        folded = self.letters.get(char) \
+            or ''.join(c for c in unicodedata.normalize('NFD', char) if unicodedata.category(c) != 'Mn')
+        # map one character to exactly one, positions in folded text match the original
+        self[char_code] = folded if len(folded) == 1 else char
+        return self[char_code]
+
+
+diacritics_folding = DiacriticsFolding()
+
+
+def normalize_diacritics(text):
+    """Remove diacritics from text for comparison, keeping its length."""
+    return text.translate(diacritics_folding)
+
+
 def parse_search_query(query):
     """Parse query into tokens (quoted phrases and individual words).
 
@@ -91,53 +224,337 @@ def build_search_patterns(query):
     return [build_token_pattern(t.text, t.is_phrase) for t in tokens]
 
 
-def search_messages(query, user):
+def quote_lexeme(text):
+    """Quote text as a single to_tsquery() operand."""
+    return "'" + text.replace('\\', '\\\\').replace("'", "''") + "'"
+
+
+def build_tsquery(tokens):
+    """Build raw to_tsquery() input for tokens that can be expressed in it.
+
+    Returns (tsquery, unsupported_tokens) tuple, tsquery is None when no token
+    could be converted:
+    - 'word' → 'word'
+    - 'word*' → 'word':*
+    - '"cat chases"' → 'cat' <-> 'chases'
+    Leading and internal wildcards have no tsquery equivalent and are left
+    for the regex lookup.
+    """
+    operands = []
+    unsupported = []
+    for token in tokens:
+        if token.is_phrase:
+            words = token.text.split()
+            if words:
+                operands.append(' <-> '.join(quote_lexeme(word) for word in words))
+            else:
+                unsupported.append(token)
+            continue
+
+        inner = token.text.rstrip('*')
+        if not inner or '*' in inner:
+            unsupported.append(token)
+        elif inner != token.text:
+            operands.append(quote_lexeme(inner) + ':*')
+        else:
+            operands.append(quote_lexeme(inner))
+
+    tsquery = ' & '.join(f'({o})' for o in operands) or None
+    return tsquery, unsupported
+
+
+def build_text_filter(query):
+    """Build filter matching message text against the query.
+
+    Returns (filter, rank) tuple, rank is an expression for ordering the
+    matches by relevance, or None if the configured engine does not rank.
+    """
+    from django.contrib.postgres.search import SearchQuery, SearchRank
+
+    tokens = parse_search_query(query)
+    text_filter = Q()
+    rank = None
+
+    if settings.SEARCH_ENGINE == 'fulltext':
+        tsquery, tokens = build_tsquery(tokens)
+        if tsquery:
+            search_query = SearchQuery(normalize_diacritics(tsquery), config=SEARCH_CONFIG, search_type='raw')
+            text_filter &= Q(search_vector=search_query)
+            rank = SearchRank(F('search_vector'), search_query)
+
+    for token in tokens:
+        pattern = build_token_pattern(token.text, token.is_phrase)
+        text_filter &= Q(text_folded__iregex=normalize_diacritics(pattern))
+
+    return text_filter, rank
+
+
+def is_ranked_search(query):
+    """Whether search_messages orders matches of the query by relevance, see build_text_filter."""
+    return settings.SEARCH_ENGINE == 'fulltext' and build_tsquery(parse_search_query(query))[0] is not None
+
+
+def normalize_search_query(query):
+    """Get hashable form of the query, equal for queries matching the same messages."""
+    tokens = {SearchToken(t.text.lower(), t.is_phrase) for t in parse_search_query(query)}
+    return tuple(sorted(tokens))
+
+
+def unlocked_rooms_filter(user, prefix='', refresh=False):
+    """Build Q matching public rooms and protected rooms unlocked by the user since their password change."""
+    room_filter = Q(**{prefix + 'password': ''})
+    if user.is_authenticated:
+        for room_id, last_entry in user_keyring(user, refresh).items():
+            room_filter |= Q(**{prefix + 'id': room_id, prefix + 'password_changed__lt': last_entry})
+    return room_filter
+
+
+def visible_room_ids(user):
+    """Get ids of public rooms and of protected rooms in user's keyring."""
+    from .models import Room
+
+    # the keyring is reloaded, rooms could have been unlocked in another process since it was cached
+    room_filter = unlocked_rooms_filter(user, refresh=True)
+    return frozenset(Room.objects.filter(room_filter).values_list('id', flat=True))
+
+
+def visible_messages(user):
+    """Get PublicMessages from rooms the user has access to, without deleted ones."""
+    from .models import PublicMessage
+
+    return PublicMessage.objects.filter(unlocked_rooms_filter(user, 'room__'), deleted_by__isnull=True)
+
+
+def search_messages(query, user, limit=None, after=None):
     r"""Search PublicMessage for matching text.
 
-    Returns a list of (thread_id, newest_match) tuples for pagination.
+    Returns a list of ThreadMatch namedtuples, newest (or with the fulltext
+    engine most relevant) threads first. At most limit threads following
+    the after cursor (see ThreadMatch.cursor) are returned.
     Uses database-level GROUP BY for efficiency.
 
     Uses PostgreSQL-specific features:
-    - unaccent() for diacritics-insensitive matching
+    - trigram indexed text_folded column for diacritics-insensitive matching
     - ~* regex operator for case-insensitive matching
     - \y for word boundaries
+    - tsvector matching and ts_rank() ordering with the fulltext engine
 
     Word order is independent - all tokens must match but in any order.
     Quoted phrases must match exactly as written.
     """
-    from .models import PublicMessage, UserRoomKeyring
-    from django.db.models import Max
-    from django.db.models.functions import Coalesce
-
-    patterns = build_search_patterns(query)
+    from django.db.models import FloatField, Max
+    from django.db.models.functions import Cast, Coalesce
 
-    # Build room access filter
-    if user.is_authenticated:
-        unlocked_room_ids = UserRoomKeyring.objects.filter(
-            user=user
-        ).values_list('room_id', flat=True)
-        room_filter = Q(room__password='') | Q(room_id__in=unlocked_room_ids)
-    else:
-        room_filter = Q(room__password='')
-
-    # Build pattern filters using custom lookup
-    pattern_filter = Q()
-    for pattern in patterns:
-        pattern_filter &= Q(text__unaccent_iregex=pattern)
+    text_filter, rank = build_text_filter(query)
 
     # Query: group by thread, get newest match date, return only IDs
     thread_matches = (
-        PublicMessage.objects
-        .filter(room_filter, deleted_by__isnull=True)
-        .filter(pattern_filter)
+        visible_messages(user)
+        .filter(text_filter)
         .annotate(effective_thread_id=Coalesce('thread_id', 'id'))
         .values('effective_thread_id')
         .annotate(newest_match=Max('created'))
-        .order_by('-newest_match')
-        .values_list('effective_thread_id', 'newest_match')
     )
+    fields = ('effective_thread_id', 'newest_match')
+    # keyset ordering, the thread id makes it unique
+    ordering = ('newest_match', 'effective_thread_id')
+    if rank is not None:
+        # ts_rank() returns real, double precision survives the round trip through the cursor
+        thread_matches = thread_matches.annotate(rank=Cast(Max(rank), FloatField()))
+        fields += ('rank',)
+        ordering = ('rank',) + ordering
+
+    if after is not None:
+        if (after.rank is None) != (rank is None):
+            raise ValueError("Search cursor does not match the search ordering.")
+        thread_matches = thread_matches.filter(build_seek_filter(ordering, after.seek_values))
+
+    thread_matches = thread_matches\
+        .order_by(*('-' + field for field in ordering))\
+        .values_list(*fields)
+    if limit is not None:
+        thread_matches = thread_matches[:limit]
+
+    return [ThreadMatch(*match) for match in thread_matches]
+
+
+def build_seek_filter(ordering, values):
+    """Build filter for rows following values in descending ordering by fields."""
+    seek_filter = Q()
+    for i in reversed(range(len(ordering))):
+        equal = {field: value for field, value in zip(ordering[:i], values[:i])}
+        seek_filter |= Q(**{ordering[i] + '__lt': values[i]}, **equal)
+    return seek_filter
+
+
+def count_search_threads(query, user):
+    """Count all threads matched by search_messages."""
+    from django.db.models import Count
+    from django.db.models.functions import Coalesce
+
+    text_filter, _ = build_text_filter(query)
+    return visible_messages(user)\
+        .filter(text_filter)\
+        .aggregate(count=Count(Coalesce('thread_id', 'id'), distinct=True))['count']
+
+
+class ThreadPosition(namedtuple('ThreadPosition', ['last_reply', 'thread_id'])):
+    """Position of a thread in a listing ordered by the newest reply."""
 
-    return list(thread_matches)
+    @property
+    def cursor(self):
+        """Position as string, for the before argument of ThreadPage."""
+        return f'{self.last_reply.isoformat()},{self.thread_id}'
+
+    @classmethod
+    def from_cursor(cls, cursor):
+        """Parse cursor string, raises ValueError for malformed input."""
+        last_reply, thread_id = cursor.split(',')
+        return cls(datetime.fromisoformat(last_reply), int(thread_id))
+
+
+class ThreadPage(object):
+    """Page of threads ordered by the newest reply, following the previous page by keyset.
+
+    Only page_size + 1 threads are fetched, the extra one just tells whether
+    there is a next page, so deep pages cost the same as the first one and
+    no total count is known.
+    """
+    def __init__(self, threads, page_size, before=None, number=1):
+        self.number = number
+        threads = list(self.fetch(threads, page_size + 1, before))
+        self.object_list = threads[:page_size]
+        self.has_next = len(threads) > page_size
+
+    @staticmethod
+    def fetch(threads, limit, before):
+        if before is not None:
+            threads = threads.filter(build_seek_filter(('last_reply', 'id'), before))
+        return threads.order_by('-last_reply', '-id')[:limit]
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    @property
+    def has_previous(self):
+        return self.number > 1
+
+    @property
+    def next_cursor(self):
+        if not self.has_next:
+            return None
+        last = self.object_list[-1]
+        return ThreadPosition(last.last_reply, last.pk).cursor
+
+    @property
+    def next_page_number(self):
+        return self.number + 1
+
+
+class InboxPage(ThreadPage):
+    """Page of private threads the user takes part in.
+
+    Threads of the page are looked up in the user's conversation participant
+    rows, which are a single index range ordered by the newest reply, and only
+    then are the threads themselves loaded.
+    """
+    def __init__(self, threads, user, page_size, before=None, number=1):
+        self.user = user
+        super(InboxPage, self).__init__(threads, page_size, before, number)
+
+    def conversation_ids(self, limit, before):
+        from .models import ConversationParticipant
+        conversations = ConversationParticipant.objects.filter(user=self.user)
+        if before is not None:
+            conversations = conversations.filter(build_seek_filter(('last_reply', 'thread_id'), before))
+        return conversations.order_by('-last_reply', '-thread_id').values_list('thread_id', flat=True)[:limit]
+
+    def fetch(self, threads, limit, before):
+        thread_ids = list(self.conversation_ids(limit, before))
+        threads = threads.in_bulk(thread_ids)
+        return [threads[pk] for pk in thread_ids if pk in threads]
+
+
+class ThreadMatch(namedtuple('ThreadMatch', ['thread_id', 'newest_match', 'rank'], defaults=[None])):
+    """Thread matched by search_messages, rank is None unless the fulltext engine is used."""
+
+    @property
+    def cursor(self):
+        """Position of the match for the after argument of search_messages, as string."""
+        if self.rank is None:
+            return f'{self.newest_match.isoformat()},{self.thread_id}'
+        return f'{self.newest_match.isoformat()},{self.thread_id},{self.rank!r}'
+
+    @classmethod
+    def from_cursor(cls, cursor, ranked):
+        """Parse cursor string of a search ranked or not (see is_ranked_search).
+
+        Raises ValueError for malformed input or a cursor of the other kind,
+        e.g. from a link created before the search engine was switched.
+        """
+        newest_match, thread_id, *rank = cursor.split(',')
+        if len(rank) != int(ranked):
+            raise ValueError("Invalid search cursor.")
+        return cls(int(thread_id), datetime.fromisoformat(newest_match), float(rank[0]) if rank else None)
+
+    @property
+    def seek_values(self):
+        if self.rank is None:
+            return self.newest_match, self.thread_id
+        return self.rank, self.newest_match, self.thread_id
+
+
+class SearchPage(object):
+    """Page of search results, following the previous page by keyset.
+
+    Only page_size + 1 threads are fetched, the extra one just tells whether
+    there is a next page. Total number of matching threads is computed lazily
+    when count is accessed.
+
+    Results are kept in search_cache, keyed by the normalized query and the
+    set of rooms visible to the user with their search versions, new posts
+    in any of the rooms bump its version.
+    """
+    def __init__(self, query, user, page_size, after=None, number=1):
+        self.query = query
+        self.user = user
+        self.number = number
+        self.rooms = visible_room_ids(user)
+        self.versions = search_versions(self.rooms)
+        matches = self.cached('threads', lambda: search_messages(query, user, limit=page_size + 1, after=after),
+                              page_size, after)
+        self.object_list = matches[:page_size]
+        self.has_next = len(matches) > page_size
+
+    def cached(self, kind, func, *args):
+        key = (kind, settings.SEARCH_ENGINE, normalize_search_query(self.query), self.rooms, self.versions) + args
+        return search_cache.get_or_set(key, func)
+
+    def matching_reply_ids(self):
+        """Get matching reply IDs for threads on the page, see get_matching_reply_ids."""
+        thread_ids = tuple(t.thread_id for t in self)
+        return self.cached('replies', lambda: get_matching_reply_ids(self.query, thread_ids, self.user), thread_ids)
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    @property
+    def next_cursor(self):
+        return self.object_list[-1].cursor if self.has_next else None
+
+    @property
+    def next_page_number(self):
+        return self.number + 1
+
+    @cached_property
+    def count(self):
+        return self.cached('count', lambda: count_search_threads(self.query, self.user))
 
 
 def get_matching_reply_ids(query, thread_ids, user):
@@ -145,33 +562,18 @@ def get_matching_reply_ids(query, thread_ids, user):
 
     Returns dict: {thread_id: [reply_id, ...]}
     """
-    from .models import PublicMessage, UserRoomKeyring
     from collections import defaultdict
 
     if not thread_ids:
         return {}
 
-    patterns = build_search_patterns(query)
-
-    # Room filter
-    if user.is_authenticated:
-        unlocked_room_ids = UserRoomKeyring.objects.filter(
-            user=user
-        ).values_list('room_id', flat=True)
-        room_filter = Q(room__password='') | Q(room_id__in=unlocked_room_ids)
-    else:
-        room_filter = Q(room__password='')
-
-    # Build pattern filters using custom lookup
-    pattern_filter = Q()
-    for pattern in patterns:
-        pattern_filter &= Q(text__unaccent_iregex=pattern)
+    text_filter, _ = build_text_filter(query)
 
     # Get only reply IDs (not root messages) for the specified threads
     reply_data = (
-        PublicMessage.objects
-        .filter(room_filter, deleted_by__isnull=True, thread_id__in=thread_ids)
-        .filter(pattern_filter)
+        visible_messages(user)
+        .filter(thread_id__in=thread_ids)
+        .filter(text_filter)
         .values_list('id', 'thread_id')
     )
 
@@ -200,7 +602,8 @@ def fetch_matching_replies(thread_ids, matching_reply_ids_by_thread):
 
     all_replies = PublicMessage.objects.filter(
         pk__in=reply_ids
-    ).select_related('author', 'room', 'room__author', 'room__moderator', 'recipient', 'deleted_by').order_by('created')
+    ).select_related('author', 'recipient', 'deleted_by').order_by('created')
+    attach_rooms(all_replies)
 
     # Group by thread_id
     replies_by_thread = {}
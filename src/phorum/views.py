@@ -1,37 +1,40 @@
 # coding=utf-8
+import logging
 from copy import copy
-from datetime import timedelta
 
-from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth import login as auth_login, logout as auth_logout
 from django.contrib.auth.decorators import login_required
-from django.core.paginator import EmptyPage, Paginator
-from django.db.models import Count, Max, Q
 from django.http import Http404, HttpResponseForbidden, HttpResponseRedirect
 from django.http.response import HttpResponseNotFound
 from django.shortcuts import redirect, render, get_object_or_404
 from django.urls import reverse
 from django.utils.http import url_has_allowed_host_and_scheme
 from django.utils.safestring import mark_safe
-from django.utils.timezone import now
 from django.views.decorators.cache import cache_control
 from django.views.decorators.debug import sensitive_post_parameters
 from django.views.decorators.http import require_POST
 from django_sendfile import sendfile
-from qsessions.models import Session
 
 from .forms import (
     LoginForm, PrivateMessageForm, PublicMessageForm, RoomCreationForm, RoomChangeForm,
     RoomPasswordPrompt, SearchForm, UserCreationForm, UserChangeForm, UserCustomizationForm
 )
-from .models import PrivateMessage, PublicMessage, Room, RoomVisit, UserCustomization
-from .utils import get_ip_addr, fetch_matching_replies, get_matching_reply_ids, search_messages, user_can_view_protected_room
+from .models import PrivateMessage, PublicMessage, Room, RoomVisit, User, UserCustomization
+from .presence import presence
+from .visits import room_visits
+from .utils import (
+    attach_rooms, get_ip_addr, get_room_or_404, fetch_matching_replies, is_ranked_search,
+    user_can_view_protected_room, search_cache,
+    InboxPage, SearchPage, ThreadMatch, ThreadPage, ThreadPosition
+)
+
+logger = logging.getLogger(__name__)
 
 
 @login_required
 def room_view(request, room_slug):
-    room = get_object_or_404(Room, slug=room_slug)
+    room = get_room_or_404(room_slug)
 
     if room.protected:
         if not request.user.is_authenticated:
@@ -42,46 +45,42 @@ def room_view(request, room_slug):
 
     try:
         page_number = int(request.GET.get("page", 1))
+        before = ThreadPosition.from_cursor(request.GET["before"]) if "before" in request.GET else None
     except ValueError:
         return HttpResponseNotFound("Invalid page number.")
 
     threads = PublicMessage.objects\
         .filter(room=room, thread=None) \
-        .order_by("-last_reply") \
         .prefetch_related("author", "children__author", "children__recipient",
-                          "room", "children__room",
                           "deleted_by", "children__deleted_by")
 
     max_threads = request.user.max_thread_roots if request.user.is_authenticated else 10
 
-    paginator = Paginator(threads, max_threads)
-
-    try:
-        threads = paginator.page(page_number)
-    except EmptyPage:
-        return HttpResponseNotFound("Invalid page number.")
+    threads = ThreadPage(threads, max_threads, before=before, number=page_number)
 
     for thread in threads:
         thread.child_messages = list(thread.children.all())
         thread.last_child = thread.child_messages[-1] if len(thread.child_messages) else None
+    attach_rooms([message for thread in threads for message in [thread] + thread.child_messages], room)
+    PublicMessage.attach_delete_permissions(threads, request.user)
 
     last_visit_time = None
     new_posts = None
     if request.user.is_authenticated:
-        # activity tracking - update last room
-        request.session['last_action'] = {
+        # activity tracking - update last room, recorded by UserActivityMiddleware
+        request.last_action = {
             'name': room.name,
             'url': request.path,
         }
 
-        visit, created = RoomVisit.objects.get_or_create(user=request.user, room=room)
-        if not created:
-            new_posts = PublicMessage.objects.filter(room=room, created__gte=visit.visit_time).count()
-            last_visit_time = visit.visit_time
-            # just update the time
-            visit.save()
+        last_visit = room_visits.last_visit(request.user.pk, room)
+        if last_visit:
+            last_visit_time, new_posts = last_visit
         else:
-            new_posts = PublicMessage.objects.filter(room=room).count()
+            # the counter of the cached room can be outdated
+            new_posts = Room.objects.filter(pk=room.pk).values_list("total_messages", flat=True).get()
+        # written later in a batch, with the counter reset
+        room_visits.record(request.user.pk, room.pk)
 
     return render(request, "phorum/room_view.html", {
         'room': room,
@@ -95,7 +94,7 @@ def room_view(request, room_slug):
 
 @login_required
 def thread_view(request, room_slug, thread_id):
-    room = get_object_or_404(Room, slug=room_slug)
+    room = get_room_or_404(room_slug)
 
     if room.protected:
         if not request.user.is_authenticated:
@@ -107,7 +106,6 @@ def thread_view(request, room_slug, thread_id):
     # get the message with prefetched children - validates it belongs to this room
     thread = PublicMessage.objects.filter(pk=thread_id, room=room)\
         .prefetch_related("author", "children__author", "children__recipient",
-                          "room", "children__room",
                           "deleted_by", "children__deleted_by")\
         .first()
 
@@ -123,12 +121,14 @@ def thread_view(request, room_slug, thread_id):
 
     thread.child_messages = list(thread.children.all())
     thread.last_child = thread.child_messages[-1] if len(thread.child_messages) else None
+    attach_rooms([thread] + thread.child_messages, room)
+    PublicMessage.attach_delete_permissions([thread], request.user)
 
     last_visit_time = None
     if request.user.is_authenticated:
-        visit = RoomVisit.objects.filter(user=request.user, room=room).first()
-        if visit:
-            last_visit_time = visit.visit_time
+        last_visit = room_visits.last_visit(request.user.pk, room)
+        if last_visit:
+            last_visit_time = last_visit[0]
 
     return render(request, "phorum/thread_view.html", {
         'room': room,
@@ -142,7 +142,7 @@ def thread_view(request, room_slug, thread_id):
 @sensitive_post_parameters("password")
 @login_required
 def room_password_prompt(request, room_slug):
-    room = get_object_or_404(Room, slug=room_slug)
+    room = get_room_or_404(room_slug)
 
     form = RoomPasswordPrompt(request.POST or None, user=request.user, room=room)
     if form.is_valid():
@@ -192,15 +192,15 @@ def room_edit(request, room_slug):
 
 @login_required
 def room_mark_unread(request, room_slug):
-    room = get_object_or_404(Room, slug=room_slug)
+    room = get_room_or_404(room_slug)
 
     if room.protected:
         if not user_can_view_protected_room(request.user, room):
             return redirect("room_password_prompt", room_slug=room_slug)
 
-    to_delete = RoomVisit.objects.filter(user=request.user, room=room)
-    if to_delete.count():
-        to_delete.delete()
+    discarded = room_visits.discard(request.user.pk, room.pk)
+    deleted, _ = RoomVisit.objects.filter(user=request.user, room=room).delete()
+    if discarded or deleted:
         messages.info(request, u"Místnost \"{}\" byla označena jako nepřečtená.".format(room.name))
 
     return redirect("home")
@@ -210,25 +210,17 @@ def room_mark_unread(request, room_slug):
 def inbox(request):
     try:
         page_number = int(request.GET.get("page", 1))
+        before = ThreadPosition.from_cursor(request.GET["before"]) if "before" in request.GET else None
     except ValueError:
         return HttpResponseNotFound("Invalid page number.")
 
-    threads = PrivateMessage.objects\
-        .filter(thread=None) \
-        .filter(Q(author=request.user) | Q(recipient=request.user)) \
-        .order_by("-last_reply") \
-        .prefetch_related("author", "children__author", "children__recipient")
-
-    paginator = Paginator(threads, request.user.max_thread_roots)
-
-    try:
-        threads = paginator.page(page_number)
-    except EmptyPage:
-        return HttpResponseNotFound("Invalid page number.")
+    threads = PrivateMessage.objects.prefetch_related("author", "recipient", "children__author", "children__recipient")
+    threads = InboxPage(threads, request.user, request.user.max_thread_roots, before=before, number=page_number)
 
     for thread in threads:
         thread.child_messages = list(thread.children.all())
         thread.last_child = thread.child_messages[-1] if len(thread.child_messages) else None
+    PrivateMessage.attach_delete_permissions(threads, request.user)
 
     # RequestContext gets instantiated here
     response = render(request, "phorum/inbox.html", {
@@ -262,7 +254,7 @@ def inbox_send(request):
 @login_required
 def message_send(request, room_slug):
     message_form = PublicMessageForm(request.POST or None, author=request.user)
-    room = get_object_or_404(Room, slug=room_slug)
+    room = get_room_or_404(room_slug)
 
     if room.protected and not user_can_view_protected_room(request.user, room):
         messages.error(request, "Do místnosti, do které zasíláte zprávu, již nemáte přístup.")
@@ -285,10 +277,12 @@ def message_send(request, room_slug):
 
 @cache_control(no_cache=True, must_revalidate=True, no_store=True, max_age=0)
 def room_list(request):
-    rooms = Room.objects.all().annotate(total_messages=Count("publicmessage"),
-                                        last_message_time=Max("publicmessage__created")).order_by("name")
+    rooms = Room.objects.all().order_by("name")
 
-    visits = RoomVisit.objects.visits_for_user(request.user) if request.user.is_authenticated else None
+    visits = None
+    if request.user.is_authenticated:
+        pending = room_visits.pending(request.user.pk, [room.pk for room in rooms])
+        visits = RoomVisit.objects.visits_for_user(request.user, pending)
 
     return render(request, "phorum/room_list.html", {
         'rooms': rooms,
@@ -308,50 +302,49 @@ def search(request):
     if request.GET and form.is_valid():
         query = form.cleaned_data['q']
 
-        # Get matching thread IDs (lightweight tuples)
-        thread_matches = search_messages(query, request.user)
-
         try:
             page_number = int(request.GET.get("page", 1))
+            after = ThreadMatch.from_cursor(request.GET["after"], is_ranked_search(query)) \
+                if "after" in request.GET else None
         except ValueError:
             return HttpResponseNotFound("Invalid page number.")
 
-        max_threads = request.user.max_thread_roots
-        paginator = Paginator(thread_matches, max_threads)
-
-        try:
-            page = paginator.page(page_number)
-        except EmptyPage:
-            return HttpResponseNotFound("Invalid page number.")
+        # Get matching thread IDs (lightweight tuples) following the previous page
+        page = SearchPage(query, request.user, request.user.max_thread_roots, after=after, number=page_number)
 
         # Extract thread IDs for this page
-        thread_ids = [t[0] for t in page]
+        thread_ids = [t.thread_id for t in page]
 
         # Fetch only the threads for this page
         threads_qs = PublicMessage.objects.filter(
             pk__in=thread_ids,
             thread__isnull=True
-        ).select_related('author', 'room', 'room__author', 'room__moderator', 'recipient', 'deleted_by')
+        ).select_related('author', 'recipient', 'deleted_by')
 
         # Sort by the order from search results
-        thread_order = {t[0]: i for i, t in enumerate(page)}
+        thread_order = {t.thread_id: i for i, t in enumerate(page)}
         threads = sorted(threads_qs, key=lambda t: thread_order[t.pk])
+        attach_rooms(threads)
 
         # Fetch matching reply IDs for this page's threads only
-        matching_reply_ids = get_matching_reply_ids(query, thread_ids, request.user)
+        matching_reply_ids = page.matching_reply_ids()
         replies_by_thread = fetch_matching_replies(thread_ids, matching_reply_ids)
 
         # Attach matching children to each thread
         for thread in threads:
             thread.child_messages = replies_by_thread.get(thread.pk, [])
+        PublicMessage.attach_delete_permissions(threads, request.user)
 
-    return render(request, "phorum/search.html", {
+    response = render(request, "phorum/search.html", {
         'form': form,
         'threads': threads,
         'page': page,
         'query': query,
         'login_form': LoginForm(),
     })
+    # the counters are local to the process, so they are logged rather than sent to clients
+    logger.debug("Search cache: hits=%(hits)d misses=%(misses)d size=%(size)d", search_cache.stats())
+    return response
 
 
 @login_required
@@ -396,6 +389,8 @@ def login(request):
 
 
 def logout(request):
+    if request.user.is_authenticated:
+        presence.remove(request.user.pk)
     auth_logout(request)
     return redirect("home")
 
@@ -453,16 +448,13 @@ def user_customization(request):
 
 @login_required
 def users(request):
-    active_threshold = now() - timedelta(minutes=settings.ACTIVE_USERS_TIMEOUT)
-
-    sessions = Session.objects\
-        .filter(user__isnull=False, expire_date__gte=now(), updated_at__gte=active_threshold)\
-        .prefetch_related('user')\
-        .order_by('user__username')\
-        .distinct('user__username')
+    active = presence.active_users()
+    users = list(User.objects.filter(pk__in=active).order_by('username'))
+    for user in users:
+        user.last_action = active[user.pk]
 
     return render(request, "phorum/users.html", {
-        'sessions': sessions
+        'users': users
     })
 
 
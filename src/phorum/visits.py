@@ -0,0 +1,129 @@
+import logging
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import DatabaseError, transaction
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+
+class RoomVisitBuffer(object):
+    """Write-behind buffer of room visits.
+
+    Visits are collected in the process and written to RoomVisit by a single
+    INSERT ... ON CONFLICT DO UPDATE once `ROOM_VISIT_BATCH_SIZE` of them are
+    pending or `ROOM_VISIT_FLUSH_INTERVAL` seconds passed since the last write,
+    the rest is written when the process exits (see PhorumConfig.ready).
+    Visits not written yet are also kept under a key per user and room in
+    a cache shared by all worker processes, reads of the user's visits merge
+    them with the stored ones, so the user sees the latest visit in any
+    process. A room marked unread keeps None under its key, so the buffers of
+    all processes skip its visits.
+    """
+    key_prefix = "roomvisits"
+
+    def __init__(self, cache_alias=None):
+        self.cache_alias = cache_alias
+        self._visits = {}
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias or settings.ROOM_VISIT_CACHE]
+
+    def key(self, user_id, room_id):
+        return "%s:%d:%d" % (self.key_prefix, user_id, room_id)
+
+    def pending(self, user_id, room_ids):
+        """Get {room_id: visit_time} of the user's visits not written yet, None for rooms marked unread."""
+        keys = {self.key(user_id, room_id): room_id for room_id in room_ids}
+        return {keys[key]: visit_time for key, visit_time in self.cache.get_many(keys).items()}
+
+    def record(self, user_id, room_id, visit_time=None):
+        visit_time = visit_time or timezone.now()
+        # a single write, so visits of other rooms in other processes can't be overwritten
+        self.cache.set(self.key(user_id, room_id), visit_time, settings.ROOM_VISIT_PENDING_TIMEOUT)
+        with self._lock:
+            self._visits[(user_id, room_id)] = visit_time
+        self.flush_if_due()
+
+    def discard(self, user_id, room_id):
+        """Forget the pending visit, e.g. when the room is marked unread.
+
+        Buffers of other processes skip the visit too. Returns whether there
+        was a pending visit.
+        """
+        with self._lock:
+            self._visits.pop((user_id, room_id), None)
+        key = self.key(user_id, room_id)
+        discarded = self.cache.get(key) is not None
+        self.cache.set(key, None, settings.ROOM_VISIT_PENDING_TIMEOUT)
+        return discarded
+
+    def last_visit(self, user_id, room):
+        """Get (visit_time, new_messages) of the user's latest visit of the room, None if not visited."""
+        from .models import RoomVisit
+
+        pending = self.cache.get(self.key(user_id, room.pk))
+        visit = RoomVisit.objects.filter(user_id=user_id, room=room).values_list("visit_time", "new_messages").first()
+        if visit and (pending is None or visit[0] >= pending):
+            return visit
+        if pending:
+            return pending, room.publicmessage_set.filter(created__gt=pending).count()
+        return None
+
+    def flush_if_due(self):
+        with self._lock:
+            due = len(self._visits) >= settings.ROOM_VISIT_BATCH_SIZE \
+                or time.monotonic() - self._last_flush >= settings.ROOM_VISIT_FLUSH_INTERVAL
+        if due:
+            self.flush()
+
+    def flush(self):
+        """Write all visits collected in the process."""
+        from .models import RoomVisit
+
+        with self._lock:
+            visits, self._visits = self._visits, {}
+            self._last_flush = time.monotonic()
+        if not visits:
+            return
+        keys = {self.key(user_id, room_id): (user_id, room_id) for user_id, room_id in visits}
+        pending = self.cache.get_many(keys)
+        expired = timezone.now() - timedelta(seconds=settings.ROOM_VISIT_PENDING_TIMEOUT)
+        upserts = []
+        for key, (user_id, room_id) in keys.items():
+            if key in pending:
+                # the latest visit in any process, None if the room was marked unread meanwhile
+                visit_time = pending[key]
+            elif visits[user_id, room_id] > expired:
+                # evicted from the cache
+                visit_time = visits[user_id, room_id]
+            else:
+                # the room could have been marked unread since, its mark expired with the visit
+                continue
+            if visit_time is not None:
+                upserts.append((user_id, room_id, visit_time))
+        try:
+            # a savepoint within a transaction, the failed write doesn't break it
+            with transaction.atomic():
+                RoomVisit.objects.upsert_visits(upserts)
+        except DatabaseError:
+            # e.g. a deadlock with a new post updating the counters of the room, the request goes on
+            logger.exception("Writing %d room visits failed, they are kept for the next flush.", len(upserts))
+            with self._lock:
+                for user_id, room_id, visit_time in upserts:
+                    # visits recorded meanwhile are newer
+                    self._visits.setdefault((user_id, room_id), visit_time)
+
+    def clear(self):
+        with self._lock:
+            self._visits.clear()
+
+
+room_visits = RoomVisitBuffer()
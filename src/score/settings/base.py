@@ -43,6 +43,8 @@ INSTALLED_APPS = (
 )
 
 MIDDLEWARE = (
+    # outermost, to count the queries of the other middleware too
+    'phorum.middleware.RequestInstrumentationMiddleware',
     'phorum.middleware.UserSessionsMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -53,13 +55,18 @@ MIDDLEWARE = (
     'django.middleware.security.SecurityMiddleware',
 )
 
-SESSION_ENGINE = 'qsessions.backends.db'
+# sessions are read from the cache and written through to the database (with user, IP and user agent)
+SESSION_ENGINE = 'qsessions.backends.cached_db'
+SESSION_CACHE_ALIAS = 'sessions'
+# minimal time between session writes caused only by user activity
+SESSION_ACTIVITY_INTERVAL = 60  # seconds
 
 ROOT_URLCONF = 'score.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        # DjangoTemplates timing the rendering, see phorum.instrumentation
+        'BACKEND': 'phorum.instrumentation.InstrumentedDjangoTemplates',
         'DIRS': [os.path.join(BASE_DIR, 'templates')],
         'APP_DIRS': True,
         'OPTIONS': {
@@ -96,6 +103,32 @@ DATABASES = {
 
 DEFAULT_AUTO_FIELD = 'django.db.models.AutoField'
 
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # rendered message fragments, see parts/message.html - kept in each worker process, so it has to stay
+    # well below the --reload-on-rss limit of uwsgi (a couple of KB per message, a few MB in total)
+    'messages': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'messages',
+        'OPTIONS': {
+            'MAX_ENTRIES': 2000,
+        },
+    },
+    # active users, see phorum.presence - has to be shared by all worker processes in production
+    'presence': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'presence',
+    },
+    # session data in front of the session table - has to be shared by all worker processes in production
+    # (see production.py), otherwise a process could keep serving a session already changed or deleted by another one
+    'sessions': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'sessions',
+    },
+}
+
 # Internationalization
 # https://docs.djangoproject.com/en/1.8/topics/i18n/
 
@@ -147,7 +180,10 @@ LOGGING = {
             'filters': ['require_debug_true'],
             'class': 'logging.StreamHandler'
         },
-
+        'warnings': {
+            'level': 'WARNING',
+            'class': 'logging.StreamHandler'
+        },
     },
     'loggers': {
         'django.request': {
@@ -155,6 +191,14 @@ LOGGING = {
             'level': 'ERROR',
             'propagate': True,
         },
+        'phorum.middleware': {
+            'level': 'WARNING',
+            'handlers': ['warnings'],
+        },
+        'phorum.visits': {
+            'level': 'WARNING',
+            'handlers': ['warnings'],
+        },
         'django.db.backends': {
             'level': 'DEBUG',
             'handlers': ['console'],
@@ -188,6 +232,41 @@ SENDFILE_URL = "/protected"
 
 
 ACTIVE_USERS_TIMEOUT = 20  # minutes
+PRESENCE_CACHE = 'presence'
+
+# message search engine - "regex" (trigram indexed regular expressions) or "fulltext" (ranked tsvector search)
+SEARCH_ENGINE = get_local_setting("SEARCH_ENGINE", "regex")
+
+# per-process cache of search results, dropped on new posts in the rooms searched
+SEARCH_CACHE_SIZE = 500  # entries
+SEARCH_CACHE_TTL = 300  # seconds
+
+# per-process cache of rooms by slug and id, invalidated by saving a room
+ROOM_CACHE_SIZE = 500  # rooms
+ROOM_CACHE_TTL = 300  # seconds
+
+# per-process cache of rooms unlocked by users, see phorum.utils.user_keyring
+KEYRING_CACHE_SIZE = 2000  # users
+KEYRING_CACHE_TTL = 600  # seconds
+
+# room visits are written in batches, see phorum.visits.RoomVisitBuffer
+ROOM_VISIT_BATCH_SIZE = 100  # visits
+ROOM_VISIT_FLUSH_INTERVAL = 10  # seconds
+# visits not written yet, has to be shared by all worker processes like the presence cache
+ROOM_VISIT_CACHE = 'presence'
+# has to outlive visits buffered in idle processes, older ones are dropped if their key is gone
+ROOM_VISIT_PENDING_TIMEOUT = 86400  # seconds
+
+# maximal number of SQL queries per request of the views, see phorum.middleware.RequestInstrumentationMiddleware
+QUERY_BUDGETS = {
+    'room_list': 10,
+    'room_view': 20,
+    'thread_view': 15,
+    'inbox': 15,
+    'search': 20,
+}
+# "log" a warning or "raise" QueryBudgetExceeded
+QUERY_BUDGET_ACTION = "log"
 
 
 # period for allowing actual delete of the message by the message author, otherwise just mark as deleted
@@ -9,6 +9,37 @@ TEMPLATES[0]['OPTIONS']['loaders'] = [
         'django.template.loaders.app_directories.Loader',
     ])]
 
+# caches shared by all uwsgi worker processes, see phorum.checks - the memcached service is expected
+# next to postgres, the image defaults PHORUM_MEMCACHED_LOCATION to memcached:11211 (see Dockerfile)
+MEMCACHED_LOCATION = get_local_setting("MEMCACHED_LOCATION", "127.0.0.1:11211")
+# fail fast, a request must not hang on an unreachable memcached
+MEMCACHED_OPTIONS = {
+    'connect_timeout': 0.5,
+    'timeout': 0.5,
+}
+CACHES = dict(CACHES, **{
+    'default': {
+        'BACKEND': 'django.core.cache.backends.memcached.PyMemcacheCache',
+        'LOCATION': MEMCACHED_LOCATION,
+        'KEY_PREFIX': 'default',
+        'OPTIONS': MEMCACHED_OPTIONS,
+    },
+    # presence and pending room visits are best effort, errors read as misses and writes are dropped,
+    # so requests don't fail when memcached is down
+    'presence': {
+        'BACKEND': 'django.core.cache.backends.memcached.PyMemcacheCache',
+        'LOCATION': MEMCACHED_LOCATION,
+        'KEY_PREFIX': 'presence',
+        'OPTIONS': dict(MEMCACHED_OPTIONS, ignore_exc=True),
+    },
+    'sessions': {
+        'BACKEND': 'django.core.cache.backends.memcached.PyMemcacheCache',
+        'LOCATION': MEMCACHED_LOCATION,
+        'KEY_PREFIX': 'sessions',
+        'OPTIONS': MEMCACHED_OPTIONS,
+    },
+})
+
 ALLOWED_HOSTS = ["scorephorum.cz", "www.scorephorum.cz", "beta.scorephorum.cz"]
 
 ADMINS = (
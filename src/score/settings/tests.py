@@ -1,4 +1,8 @@
 from .production import *
+from . import base
+
+# tests run in a single process, the process local caches will do
+CACHES = base.CACHES
 
 STATICFILES_STORAGE = 'django.contrib.staticfiles.storage.StaticFilesStorage'
 
@@ -8,4 +12,7 @@ PASSWORD_HASHERS = ['django.contrib.auth.hashers.MD5PasswordHasher']
 # Use default Google test keys and silence error
 del RECAPTCHA_PUBLIC_KEY
 del RECAPTCHA_PRIVATE_KEY
-SILENCED_SYSTEM_CHECKS = ['django_recaptcha.recaptcha_test_key_error']
+SILENCED_SYSTEM_CHECKS = ['django_recaptcha.recaptcha_test_key_error', 'phorum.E001']
+
+# views have to keep within their query budgets
+QUERY_BUDGET_ACTION = "raise"